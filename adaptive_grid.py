@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+adaptive (quadtree) sampling of the commute grid.
+
+rather than sampling every point of a fine npts x npts grid, we start from
+a coarse grid and only subdivide cells that look interesting:  those where
+the commute times at the corners straddle a threshold (e.g. the longest
+happy commute) or differ by more than some tolerance.  everything happens
+in integer coordinates on the finest lattice the refinement can reach, so
+points are shared between neighboring cells and have stable ids.
+"""
+
+
+def fine_lattice_size(npts, max_depth):
+    """
+    number of points on each side of the finest lattice we can refine to
+    """
+    return (npts - 1) * 2**max_depth + 1
+
+def cell_corners(ix, iy, size):
+    return [(ix, iy), (ix + size, iy), (ix, iy + size), (ix + size, iy + size)]
+
+def cell_score(values, threshold, tolerance):
+    """
+    how much a cell needs refining, given the results at its corners (None
+    for points that failed).  returns 0 if it doesn't need refining, and
+    otherwise the largest spread in any of the commutes (so the most
+    uncertain cells get refined first when we're up against the budget)
+    """
+    values = [v for v in values if v is not None]
+    if len(values) < 2:
+        return 0
+
+    score = 0
+    for key in values[0]:
+        vals = [v[key] for v in values]
+        spread = max(vals) - min(vals)
+        if min(vals) <= threshold < max(vals) or spread > tolerance:
+            score = max(score, spread, 1e-9)
+    return score
+
+def adaptive_sample(evaluate_points, npts, max_depth, threshold, tolerance, max_points=None, 
+    queryable=None):
+    """
+    evaluate_points takes a list of (ix, iy) lattice points and returns a
+    dict mapping each one to its result (a dict of commute times) or None
+    if it failed.  it's called once per level of refinement, so it can
+    evaluate the points concurrently.
+
+    starts from a npts x npts grid and refines up to max_depth times, never
+    evaluating more than max_points points in total (if given).  if given,
+    queryable(point) says whether evaluating point actually costs a query
+    (e.g. it's False for points out over the ocean, which evaluate_points
+    returns as None for free); only those count towards max_points.
+
+    returns the leaf cells as a list of (ix, iy, size, corner_results),
+    where (ix, iy) is the lower left corner and size is the width of the
+    cell, all in units of the finest lattice spacing
+    """
+    size = 2**max_depth
+    cells = [(ix*size, iy*size, size) for ix in range(npts - 1) for iy in range(npts - 1)]
+    results = {}
+    if queryable is None:
+        queryable = lambda point: True
+
+    ## number of points we've queried so far
+    spent = 0
+
+    def evaluate(points):
+        nonlocal spent
+        points = sorted(set(p for p in points if p not in results))
+        if len(points):
+            results.update(evaluate_points(points))
+            spent += sum(1 for point in points if queryable(point))
+
+    evaluate([corner for cell in cells for corner in cell_corners(*cell)])
+
+    leaves = []
+    while len(cells):
+        ## refine the most uncertain cells first, until we run out of budget
+        scored = [(cell_score([results[c] for c in cell_corners(*cell)], threshold, tolerance), cell)
+            for cell in cells]
+        scored.sort(key=lambda sc: -sc[0])
+
+        to_split = []
+        new_points = set()
+        new_cost = 0
+        for score, cell in scored:
+            ix, iy, size = cell
+            if score <= 0 or size == 1:
+                leaves.append(cell)
+                continue
+
+            half = size//2
+            children = [(ix, iy, half), (ix + half, iy, half), (ix, iy + half, half), (ix + half, iy + half, half)]
+            points = set(c for child in children for c in cell_corners(*child)) - set(results) - new_points
+            cost = sum(1 for point in points if queryable(point))
+            if max_points is not None and spent + new_cost + cost > max_points:
+                leaves.append(cell)
+                continue
+
+            new_points |= points
+            new_cost += cost
+            to_split.extend(children)
+
+        evaluate(new_points)
+        cells = to_split
+
+    return [(ix, iy, size, [results[c] for c in cell_corners(ix, iy, size)]) for ix, iy, size in leaves]
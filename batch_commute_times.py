@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+"""
+commute times for a whole list of addresses (e.g. the day's listings) in
+one go:  addresses are streamed in from a file or stdin, worked on a few
+at a time with a shared client and cache, and each result is written out
+as soon as it's done.  only a bounded number of addresses are in flight
+at once, so memory doesn't grow with the size of the input.
+
+input is csv (with an `address` column, and optionally an `id` column) or
+jsonl (objects with `address` and optionally `id`, or bare strings), and
+output is jsonl or csv with the min/max/mean of each commute over the
+days, per traffic model.  results come out in the order they finish;
+`index` is the position of the address in the input.
+"""
+
+import sys
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from commute_times import CommuteTimesClass, DistanceMatrixClass
+
+MODELS = ['pessimistic', 'optimistic', 'best_guess']
+STATS = ['min', 'max', 'mean']
+
+
+def read_addresses(f, input_format):
+    """
+    yield (id, address) for every line of f
+    """
+    if input_format == 'csv':
+        for row in csv.DictReader(f):
+            if row.get('address'):
+                yield row.get('id'), row['address']
+    else:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                yield None, record
+            else:
+                yield record.get('id'), record['address']
+
+def summarize(times):
+    """
+    {'<name>_<direction>': {model: [minutes, ...]}} ->
+        {'<name>_<direction>': {model: {'min': ..., 'max': ..., 'mean': ...}}}
+    """
+    return {key: {model: dict(min=min(values), max=max(values), mean=sum(values)/len(values))
+        for model, values in models.items()} for key, models in times.items()}
+
+
+class ResultWriter:
+    """
+    writes one result per address, as jsonl or as csv with a column per
+    commute, model and statistic (e.g. alice_towork_best_guess_mean)
+    """
+    def __init__(self, f, output_format, commutes, models):
+        self.f = f
+        self.output_format = output_format
+        if output_format == 'csv':
+            self.columns = [f'{name}_{direction}_{model}_{stat}' for name in commutes
+                for direction in ['towork', 'tohome'] for model in models for stat in STATS]
+            self.writer = csv.DictWriter(f, ['index', 'id', 'address', 'error'] + self.columns)
+            self.writer.writeheader()
+
+    def write(self, result):
+        if self.output_format == 'csv':
+            row = {key: result.get(key) for key in ['index', 'id', 'address', 'error']}
+            for key, models in result.get('commutes', {}).items():
+                for model, stats in models.items():
+                    for stat, value in stats.items():
+                        row[f'{key}_{model}_{stat}'] = round(value, 2)
+            self.writer.writerow(row)
+        else:
+            self.f.write(json.dumps(result) + '\n')
+        self.f.flush()
+
+
+def stream_commute_times(CommuteTimes, addresses, commutes, year, month, first_day, ndays, timezone,
+    models=MODELS, nworkers=4, max_pending=None, initializer=None):
+    """
+    yield a result dict for each (id, address) in addresses, in the order
+    they finish, working on up to nworkers addresses at once and reading
+    at most max_pending (default 2*nworkers) addresses ahead.  failures
+    are reported in the result's error rather than raised.  initializer
+    is run in each worker thread as it starts (e.g. Profiler.start)
+    """
+    max_pending = max_pending or 2*nworkers
+
+    def evaluate(index, id, address):
+        result = dict(index=index, address=address)
+        if id is not None:
+            result['id'] = id
+        try:
+            times = CommuteTimes.get_commute_times(address, commutes, year, month, first_day, ndays,
+                timezone, models=models, do_print=False, do_pbar=False, return_model=None)
+            result['commutes'] = summarize(times)
+            result['requests'] = CommuteTimes.last_plan['requests']
+        except ValueError as e:
+            result['error'] = str(e).splitlines()[0]
+        finally:
+            ## nothing else will need this address's samples
+            CommuteTimes.forget_address(address)
+        return result
+
+    with ThreadPoolExecutor(max_workers=nworkers, initializer=initializer) as executor:
+        pending = set()
+        for index, (id, address) in enumerate(addresses):
+            pending.add(executor.submit(evaluate, index, id, address))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while len(pending):
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def main():
+    from argparse import ArgumentParser
+    from tqdm import tqdm
+    from load_config import load_config
+    from rate_limit import RateLimiter
+    from response_cache import add_cache_arguments, cache_from_args
+    from transports import add_transport_arguments, transport_from_args
+    from metrics import add_metrics_arguments, Profiler
+    from geocode import add_geocode_arguments, geocode_cache_from_args
+
+    parser = ArgumentParser()
+    parser.add_argument('input', nargs='?', default='-', help="File of addresses (csv or jsonl), or - for stdin")
+    parser.add_argument('-o', '--output', default='-', help="File to write results to, or - for stdout")
+    parser.add_argument('--input_format', default=None, choices=['csv', 'jsonl'],
+        help="Format of the input (defaults to the file's extension, or jsonl)")
+    parser.add_argument('--output_format', default=None, choices=['csv', 'jsonl'],
+        help="Format of the output (defaults to the file's extension, or jsonl)")
+    parser.add_argument('-c', '--config_filename', dest='config_filename', help="Config file with private info", default=None)
+    parser.add_argument('--year', default=2019, type=int)
+    parser.add_argument('--month', default=8, type=int)
+    parser.add_argument('--first_day', default=6, help="Start on Aug 6 2019, a Tuesday", type=int)
+    parser.add_argument('--ndays', default=4, help="How many days to run for (i.e. work week)", type=int)
+    parser.add_argument('--models', default=MODELS, nargs='+', choices=MODELS, help="Traffic models to report on")
+    parser.add_argument('--nworkers', default=4, type=int, help="Number of addresses to work on at once")
+    parser.add_argument('--max_qps', default=50, type=float, help="Maximum number of API requests per second")
+    parser.add_argument('--backend', default='directions', choices=['directions', 'matrix'],
+        help="Query the Directions API one route at a time, or batch requests through the Distance Matrix API")
+    parser.add_argument('--api_root', default="https://maps.googleapis.com/maps/api/",
+        help="Root url of the maps API (e.g. to point at stub_server.py)")
+    add_cache_arguments(parser)
+    add_transport_arguments(parser)
+    add_geocode_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+
+    def file_format(filename, given):
+        if given is not None:
+            return given
+        return 'csv' if filename.endswith('.csv') else 'jsonl'
+
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler(args.profile)
+        profiler.start()
+
+    config, timezone = load_config(args.config_filename)
+    commutes = config['commutes']
+    backend = DistanceMatrixClass if args.backend == 'matrix' else CommuteTimesClass
+    CommuteTimes = backend(key=config['api_key'], cache=cache_from_args(args), offline=args.offline,
+        api_root=args.api_root, rate_limiter=RateLimiter(args.max_qps),
+        transport=transport_from_args(args, max(10, args.nworkers)),
+        geocode=args.geocode, geocode_cache=geocode_cache_from_args(args), precision=args.precision)
+
+    infile = sys.stdin if args.input == '-' else open(args.input, 'r', newline='')
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    writer = ResultWriter(outfile, file_format(args.output, args.output_format), commutes, args.models)
+
+    nerrors = 0
+    results = stream_commute_times(CommuteTimes, read_addresses(infile, file_format(args.input, args.input_format)),
+        commutes, args.year, args.month, args.first_day, args.ndays, timezone,
+        models=args.models, nworkers=args.nworkers, 
+        initializer=profiler.start if profiler is not None else None)
+    try:
+        for result in tqdm(results, desc="Addresses", unit=' addresses'):
+            writer.write(result)
+            nerrors += 'error' in result
+    except KeyboardInterrupt:
+        print("Interrupted", file=sys.stderr)
+    finally:
+        if outfile is not sys.stdout:
+            outfile.close()
+
+    ## the summary goes to stderr, so it doesn't end up mixed in with the results
+    if nerrors:
+        print(f"{nerrors} addresses failed (see their error field)", file=sys.stderr)
+    if CommuteTimes.cache is not None:
+        print(CommuteTimes.cache.summary(), file=sys.stderr)
+    if CommuteTimes.geocode_cache is not None:
+        print(CommuteTimes.geocode_cache.summary(), file=sys.stderr)
+    print(CommuteTimes.metrics.report(), file=sys.stderr)
+    if args.metrics is not None:
+        CommuteTimes.metrics.write(args.metrics, extra=dict(input=args.input, backend=args.backend))
+    if profiler is not None:
+        profiler.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""
+benchmarks for the commute pipeline that never touch the real API, so we
+can measure API calls, wall time and throughput without spending money:
+
+    solver:    calls per find_depart_time solve (vs the old fixed-step
+               search) against a stubbed duration curve:  a rush-hour bump
+               per route, or a recorded curve via --curve_file
+    commutes:  get_commute_times for random addresses, using the synthetic
+               transport (with --latency per request)
+    grid:      full build_commute_grid.py runs for several values of npts,
+               using the synthetic transport
+"""
+
+import io
+import os
+import math
+import time
+import random
+import bisect
+import tempfile
+import threading
+import contextlib
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, parse_qsl
+
+import pytz
+import yaml
+
+from commute_times import CommuteTimesClass
+from transports import TransportResponse, SyntheticTransport
+
+MODEL_FACTORS = {'optimistic': 0.75, 'best_guess': 1.0, 'pessimistic': 1.35}
+
+## bounds of the default grid in build_commute_grid.py
+BOUNDS = dict(northern_limit=34.219498, southern_limit=33.816168,
+    eastern_limit=-118.254013, western_limit=-118.606110)
+COMMUTES = {
+    'alice': dict(address='34.052235,-118.243683', arrival_hour=9, arrival_minute=0,
+        departure_hour=17, departure_minute=30),
+    'bob': dict(address='34.147785,-118.144516', arrival_hour=8, arrival_minute=30,
+        departure_hour=17, departure_minute=0),
+}
+
+
+class CurveTransport:
+    """
+    transport that answers Directions requests with durations from
+    duration(route, minute_of_day) * MODEL_FACTORS[traffic_model], and 
+    counts every request in self.calls
+    """
+    def __init__(self, duration, timezone):
+        self.duration = duration
+        self.timezone = timezone
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def true_duration(self, route, departure_time, traffic_model):
+        local = departure_time.astimezone(self.timezone)
+        minute = local.hour*60 + local.minute + local.second/60
+        return self.duration(route, minute) * MODEL_FACTORS[traffic_model]
+
+    def get(self, url, timeout=None):
+        with self.lock:
+            self.calls += 1
+        params = dict(parse_qsl(urlsplit(url).query))
+        departure_time = datetime.fromtimestamp(int(params['departure_time']), tz=pytz.utc)
+        travel_time = self.true_duration((params['origin'], params['destination']),
+            departure_time, params.get('traffic_model', 'best_guess'))
+        return TransportResponse(200, {'status': 'OK', 
+            'routes': [{'legs': [{'duration_in_traffic': {'value': travel_time*60}}]}]})
+
+
+def fixed_step_depart_time(ct, departure_address, arrival_address, target_arrival_time,
+    guess=45, early_tolerance=7, late_tolerance=0, initial_step=20,
+    min_step=5, max_calls=8, **kwargs):
+    """
+    the original fixed-step search from find_depart_time, kept as a reference
+    """
+    def get_departure_from_guess(this_guess):
+        return target_arrival_time - timedelta(minutes=this_guess)
+
+    def get_difference(this_guess):
+        this_time = get_departure_from_guess(this_guess)
+        travel_time = ct.get_estimated_time(departure_address,
+            arrival_address, departure_time=this_time, **kwargs)
+        arrival_time = this_time + timedelta(minutes=travel_time)
+        return (target_arrival_time - arrival_time).total_seconds()/60
+
+    difference = get_difference(guess)
+    step = initial_step
+    calls = 1
+    while (difference < -1*abs(late_tolerance)) or (difference > early_tolerance):
+        if difference > 0:
+            guess = guess - step
+        else:
+            guess = guess + step
+        difference = get_difference(guess)
+        step = max(min_step, 0.75*step)
+
+        calls += 1
+        if calls > max_calls:
+            break
+
+    return get_departure_from_guess(guess)
+
+
+def rush_hour_curve(nroutes, seed=0):
+    """
+    random routes with a free-flow time plus a morning rush hour bump
+    """
+    rng = random.Random(seed)
+    routes = {}
+    for ii in range(nroutes):
+        routes[(f'home{ii}', f'work{ii}')] = (rng.uniform(10, 70),
+            rng.uniform(5, 45), rng.uniform(7.5*60, 9*60), rng.uniform(40, 90))
+
+    def duration(route, minute):
+        free_flow, delay, peak, width = routes[route]
+        return free_flow + delay*math.exp(-0.5*((minute - peak)/width)**2)
+
+    return list(routes), duration
+
+def recorded_curve(filename, nroutes, seed=0):
+    """
+    routes that all follow a recorded (minute of day, minutes) curve, read
+    from a two-column csv, shifted by a random offset per route
+    """
+    minutes, durations = [], []
+    with open(filename, 'r') as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            m, d = line.split(',')[:2]
+            minutes.append(float(m))
+            durations.append(float(d))
+
+    rng = random.Random(seed)
+    offsets = {(f'home{ii}', f'work{ii}'): rng.uniform(-10, 10) for ii in range(nroutes)}
+
+    def duration(route, minute):
+        ii = min(max(bisect.bisect(minutes, minute), 1), len(minutes) - 1)
+        frac = (minute - minutes[ii-1])/(minutes[ii] - minutes[ii-1])
+        frac = min(max(frac, 0), 1)
+        return max(1, durations[ii-1] + frac*(durations[ii] - durations[ii-1]) + offsets[route])
+
+    return list(offsets), duration
+
+
+def run_solver(name, solve, routes, duration, timezone, arrivals, ndays, models,
+    early_tolerance=7, late_tolerance=0):
+    calls_per_solve = []
+    ok = 0
+    start = time.perf_counter()
+    for route in routes:
+        ## one instance per route, like one get_commute_times call per address
+        transport = CurveTransport(duration, timezone)
+        ct = CommuteTimesClass(key='stub', transport=transport)
+        for hour, minute in arrivals:
+            for day in range(6, 6 + ndays):
+                for model in models:
+                    target = timezone.localize(datetime(2019, 8, day, hour, minute))
+                    before = transport.calls
+                    departure = solve(ct, route[0], route[1], target, traffic_model=model,
+                        early_tolerance=early_tolerance, late_tolerance=late_tolerance)
+                    calls_per_solve.append(transport.calls - before)
+
+                    arrival = departure + timedelta(minutes=transport.true_duration(route, departure, model))
+                    difference = (target - arrival).total_seconds()/60
+                    ok += (-1*abs(late_tolerance) <= difference <= early_tolerance)
+    elapsed = time.perf_counter() - start
+
+    nsolves = len(calls_per_solve)
+    print(f"{name.ljust(20)} {sum(calls_per_solve)/nsolves:8.2f} {max(calls_per_solve):10d}" +
+          f" {100*ok/nsolves:13.1f}%  ({nsolves} solves, {sum(calls_per_solve)} calls, {elapsed:.2f}s)")
+
+def benchmark_solver(args):
+    timezone = pytz.timezone('America/Los_Angeles')
+    if args.curve_file is not None:
+        routes, duration = recorded_curve(args.curve_file, args.nroutes, args.seed)
+    else:
+        routes, duration = rush_hour_curve(args.nroutes, args.seed)
+
+    arrivals = [(8, 0), (9, 0), (9, 30)]
+    models = ['pessimistic', 'optimistic', 'best_guess']
+
+    print("solver".ljust(20) + " calls/solve  max calls  within tolerance")
+    print('-'*66)
+    run_solver('fixed step (old)', fixed_step_depart_time, routes, duration, timezone,
+        arrivals, args.ndays, models)
+    run_solver('secant', lambda ct, *a, **kw: ct.find_depart_time(*a, **kw), routes,
+        duration, timezone, arrivals, args.ndays, models)
+
+def random_addresses(n, seed=0):
+    rng = random.Random(seed)
+    return [f"{rng.uniform(BOUNDS['southern_limit'], BOUNDS['northern_limit']):.6f}," + 
+            f"{rng.uniform(BOUNDS['western_limit'], BOUNDS['eastern_limit']):.6f}" for _ in range(n)]
+
+def benchmark_commutes(args):
+    timezone = pytz.timezone('America/Los_Angeles')
+    addresses = random_addresses(args.naddresses, args.seed)
+
+    transport = SyntheticTransport(latency=args.latency, timezone=timezone)
+    ct = CommuteTimesClass(key='stub', transport=transport)
+    start = time.perf_counter()
+    for address in addresses:
+        ct.get_commute_times(address, COMMUTES, 2019, 8, 6, args.ndays, timezone,
+            do_print=False, do_pbar=False)
+    elapsed = time.perf_counter() - start
+
+    print(f"get_commute_times:  {len(addresses)} addresses x {len(COMMUTES)} people x {args.ndays} days x 3 models")
+    print(f"    {transport.calls} API calls ({transport.calls/len(addresses):.1f} per address)" + 
+          f" in {elapsed:.2f}s ({len(addresses)/elapsed:.2f} addresses/s, {transport.calls/elapsed:.1f} calls/s)")
+
+def benchmark_grid(args):
+    import build_commute_grid
+
+    print("npts".rjust(6) + "points".rjust(9) + "API calls".rjust(11) + "calls/point".rjust(13) + 
+          "wall time".rjust(11) + "points/s".rjust(10))
+    print('-'*60)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config_filename = os.path.join(tmpdir, 'config.yml')
+        with open(config_filename, 'w') as f:
+            yaml.safe_dump(dict(timezone='America/Los_Angeles', api_key='stub', commutes=COMMUTES), f)
+
+        for npts in args.npts:
+            outname = os.path.join(tmpdir, f'grid_{npts}')
+            argv = [outname, '-c', config_filename, '--state_name', 'None', '--npts', str(npts),
+                '--transport', 'synthetic', '--latency', str(args.latency), 
+                '--nworkers', str(args.nworkers), '--max_qps', '1e9']
+            for key, value in BOUNDS.items():
+                argv += [f'--{key}', str(value)]
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                ct = build_commute_grid.main(argv)
+            elapsed = time.perf_counter() - start
+
+            calls = ct.transport.calls
+            print(f"{npts:6d}{npts**2:9d}{calls:11d}{calls/npts**2:13.1f}{elapsed:10.2f}s{npts**2/elapsed:10.2f}")
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('mode', nargs='?', default='solver', choices=['solver', 'commutes', 'grid'])
+    parser.add_argument('--nroutes', default=50, type=int, help="Number of (home, work) routes to solve for (solver)")
+    parser.add_argument('--naddresses', default=20, type=int, help="Number of addresses to get commutes for (commutes)")
+    parser.add_argument('--npts', default=[3, 5, 8], type=int, nargs='+', help="Grid sizes to build (grid)")
+    parser.add_argument('--nworkers', default=8, type=int, help="Number of concurrent grid points (grid)")
+    parser.add_argument('--ndays', default=4, type=int)
+    parser.add_argument('--latency', default=0.05, type=float, help="Seconds per synthetic request (commutes, grid)")
+    parser.add_argument('--curve_file', default=None,
+        help="csv of (minute of day, best-guess minutes) to use instead of the synthetic rush hour (solver)")
+    parser.add_argument('--seed', default=0, type=int)
+
+    args = parser.parse_args()
+
+    {'solver': benchmark_solver, 'commutes': benchmark_commutes, 'grid': benchmark_grid}[args.mode](args)
+
+if __name__ == "__main__":
+    main()
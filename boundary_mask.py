@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""
+masks for which grid points are on land (or inside whatever area you
+care about), for build_commute_grid.py.  the boundary is either a state
+from the Natural Earth admin_1 shapefile (via cartopy) or any polygons in
+a GeoJSON file (e.g. a few neighborhoods drawn on geojson.io).
+
+everything expensive is cached in cache_dir:
+
+    state_<name>.wkb:   the state's geometry, simplified, so the shapefile
+                        only has to be downloaded and scanned once
+    masks/<key>.npy:    computed masks, keyed on the boundary and the grid
+                        (bounds and number of points)
+
+so once a grid has been masked, rebuilding it doesn't need the network,
+cartopy, or even shapely.  cache files are written atomically, so several
+processes can share a cache directory.
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'commute_times')
+
+## in degrees; ~100m, far finer than any grid we'd query
+DEFAULT_SIMPLIFY = 0.001
+
+## part of every mask's cache key; bump it whenever the way masks are 
+## computed changes, so stale masks in the cache are ignored
+MASK_VERSION = 2
+
+
+def write_atomically(filename, write):
+    """
+    call write(f) on a temporary file next to filename, then move it into
+    place, so other processes never see a partially written file
+    """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, filename)
+
+def state_geometry(state_name, cache_dir=DEFAULT_CACHE_DIR, simplify=DEFAULT_SIMPLIFY):
+    """
+    the (simplified) boundary of state_name, from the cache if possible
+    """
+    import shapely.wkb
+
+    filename = os.path.join(cache_dir, f"state_{state_name.replace(' ', '_')}_{simplify:g}.wkb")
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            return shapely.wkb.loads(f.read())
+
+    import cartopy.io.shapereader as shpreader
+
+    shpfilename = shpreader.natural_earth(resolution='10m',
+                                          category='cultural',
+                                          name='admin_1_states_provinces')
+    reader = shpreader.Reader(shpfilename)
+    geom = None
+    for state in reader.records():
+        if state.attributes['name'] == state_name:
+            geom = state.geometry
+            break
+    if geom is None:
+        raise ValueError(f"No state named {state_name} in the Natural Earth admin_1 shapefile")
+
+    if simplify:
+        geom = geom.simplify(simplify, preserve_topology=True)
+    write_atomically(filename, lambda f: f.write(shapely.wkb.dumps(geom)))
+    return geom
+
+def geojson_geometry(filename):
+    """
+    the union of every polygon in a GeoJSON file (a FeatureCollection, a
+    single Feature, or a bare geometry)
+    """
+    import shapely.geometry as sgeom
+    from shapely.ops import unary_union
+
+    with open(filename, 'r') as f:
+        data = json.load(f)
+    if data.get('type') == 'FeatureCollection':
+        geometries = [feature['geometry'] for feature in data['features']]
+    elif data.get('type') == 'Feature':
+        geometries = [data['geometry']]
+    else:
+        geometries = [data]
+    return unary_union([sgeom.shape(geometry) for geometry in geometries])
+
+def contains(geom, xvals, yvals):
+    """
+    which of the points (xvals, yvals) are inside geom.  only points inside
+    geom's bounding box are tested, against a prepared copy of the geometry
+    """
+    xvals, yvals = np.asarray(xvals), np.asarray(yvals)
+    minx, miny, maxx, maxy = geom.bounds
+    inside = (xvals >= minx) & (xvals <= maxx) & (yvals >= miny) & (yvals <= maxy)
+    if not inside.any():
+        return inside
+
+    try:
+        ## shapely 2
+        import shapely
+        shapely.prepare(geom)
+        inside[inside] = shapely.contains_xy(geom, xvals[inside], yvals[inside])
+    except AttributeError:
+        import shapely.vectorized
+        inside[inside] = shapely.vectorized.contains(geom, xvals[inside], yvals[inside])
+    return inside
+
+
+def mask_key(source, bounds, nside):
+    """
+    cache key for the mask of an nside x nside grid over bounds (west,
+    south, east, north) for the boundary described by source
+    """
+    blob = json.dumps(dict(source=source, bounds=[round(b, 8) for b in bounds], nside=nside,
+        version=MASK_VERSION), sort_keys=True)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()[:24]
+
+def boundary_mask(xvals, yvals, bounds, nside, state_name=None, geojson=None,
+    cache_dir=DEFAULT_CACHE_DIR, simplify=DEFAULT_SIMPLIFY):
+    """
+    mask of the grid points (xvals, yvals) that are inside state_name
+    and/or the polygons in the GeoJSON file geojson (everything, if
+    neither is given).  bounds (west, south, east, north) and nside
+    describe the grid, for the mask cache
+    """
+    if state_name is None and geojson is None:
+        return np.ones(np.size(xvals), dtype=bool)
+
+    source = dict(state_name=state_name, simplify=simplify)
+    if geojson is not None:
+        with open(geojson, 'rb') as f:
+            source['geojson'] = hashlib.sha256(f.read()).hexdigest()
+    filename = os.path.join(cache_dir, 'masks', mask_key(source, bounds, nside) + '.npy')
+    if os.path.exists(filename):
+        mask = np.load(filename)
+        if mask.size == np.size(xvals):
+            return mask
+
+    import shapely.geometry as sgeom
+
+    ## only the part of the boundary that overlaps the grid matters, which
+    ## for a city-sized grid is a tiny fraction of a state.  the outermost 
+    ## grid points sit exactly on the edges of the grid's bounds, and points
+    ## on the boundary don't count as inside, so clip to a slightly bigger box
+    west, south, east, north = bounds
+    pad = 0.01*max(abs(east - west), abs(north - south), 1e-3)
+    area = sgeom.box(min(west, east) - pad, min(south, north) - pad, max(west, east) + pad, max(south, north) + pad)
+    mask = np.ones(np.size(xvals), dtype=bool)
+    if state_name is not None:
+        mask &= contains(state_geometry(state_name, cache_dir, simplify).intersection(area), xvals, yvals)
+    if geojson is not None:
+        mask &= contains(geojson_geometry(geojson).intersection(area), xvals, yvals)
+
+    write_atomically(filename, lambda f: np.save(f, mask))
+    return mask
+
+
+def add_boundary_arguments(parser):
+    parser.add_argument('--state_name', default="California",
+        help="State to use for the boundary to distinguish land from water.  Points outside the state are discarded")
+    parser.add_argument('--geojson', default=None,
+        help="GeoJSON file of polygons to clip the grid to (in addition to --state_name, unless that's None)")
+    parser.add_argument('--boundary_cache', default=DEFAULT_CACHE_DIR,
+        help="Directory to cache state boundaries and grid masks in")
+    parser.add_argument('--simplify', default=DEFAULT_SIMPLIFY, type=float,
+        help="Tolerance (in degrees) to simplify state boundaries to before masking")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+keeping grid runs inside a budget:  estimate how many API requests (and
+how much money) a run will take before starting it, and stop a run
+once it hits a hard ceiling on requests or cost.
+
+Directions requests with traffic and Distance Matrix elements with
+traffic are both billed at the "advanced" rate, which is $0.01 each at
+the time of writing (see --cost_per_request).
+"""
+
+import json
+import threading
+
+## API requests per departure time search, if we don't have a metrics
+## file from a previous run to go on (the secant search averages ~1.2 on
+## the benchmark, but grid points far from work take a few more)
+DEFAULT_SOLVE_REQUESTS = 2.0
+
+
+class BudgetExceeded(Exception):
+    """
+    raised when a request would go over the budget.  deliberately not a
+    ValueError, so it isn't mistaken for a point with no route
+    """
+    pass
+
+class RequestBudget:
+    """
+    thread-safe ceiling on the number of requests (or billed elements,
+    for the Distance Matrix API) and their cost.  every request to the API
+    is charged before it's sent, and raises BudgetExceeded if it would go
+    over max_requests or max_cost
+    """
+    def __init__(self, max_requests=None, max_cost=None, cost_per_request=0.01):
+        self.max_requests = max_requests
+        self.max_cost = max_cost
+        self.cost_per_request = cost_per_request
+        self.used = 0
+        self.exceeded = False
+        self.lock = threading.Lock()
+
+    @property
+    def cost(self):
+        return self.used*self.cost_per_request
+
+    def charge(self, elements=1):
+        with self.lock:
+            used = self.used + elements
+            if ((self.max_requests is not None and used > self.max_requests) or
+                (self.max_cost is not None and used*self.cost_per_request > self.max_cost)):
+                self.exceeded = True
+                raise BudgetExceeded(f"Out of budget after {self.used} requests (${self.cost:.2f})")
+            self.used = used
+
+    def summary(self):
+        limits = []
+        if self.max_requests is not None:
+            limits.append(f"{self.max_requests} requests")
+        if self.max_cost is not None:
+            limits.append(f"${self.max_cost:.2f}")
+        return f"Used {self.used} requests (${self.cost:.2f}) of a budget of {' or '.join(limits) or 'unlimited'}"
+
+
+def solve_requests_from_metrics(filename):
+    """
+    average API requests per departure time search in a --metrics json
+    file from a previous run
+    """
+    with open(filename, 'r') as f:
+        summary = json.load(f)
+    mean = summary.get('histograms', {}).get('solve_requests', {}).get('mean')
+    if mean is None:
+        raise ValueError(f"No departure time searches recorded in {filename}")
+    return mean
+
+def estimate_point_requests(plan, solve_requests=DEFAULT_SOLVE_REQUESTS):
+    """
+    expected API requests for one point, from its (planned) queries:  one
+    per unique commute home, and solve_requests per unique commute to work
+    """
+    queries = set(plan.values())
+    ntowork = sum(q[0] == 'towork' for q in queries)
+    return ntowork*solve_requests + (len(queries) - ntowork)
+
+def print_estimate(npoints, point_requests, cost_per_request, max_qps=None, label="points"):
+    total = npoints*point_requests
+    print(f"Estimated {total:.0f} API requests (${total*cost_per_request:.2f}) for {npoints} {label}, " +
+          f"~{point_requests:.1f} per point")
+    if max_qps:
+        print(f"At {max_qps:g} requests per second, that'll take at least {total/max_qps/60:.1f} minutes")
+    return total
+
+
+def add_budget_arguments(parser):
+    parser.add_argument('--dry_run', action='store_true',
+        help="Estimate the number (and cost) of API requests for the run, then stop without making any")
+    parser.add_argument('--max_requests', default=None, type=int,
+        help="Stop (and save what's done) before making more than this many API requests")
+    parser.add_argument('--max_cost', default=None, type=float,
+        help="Stop (and save what's done) before spending more than this many dollars")
+    parser.add_argument('--cost_per_request', default=0.01, type=float,
+        help="Dollars per request (per element for the Distance Matrix API)")
+    parser.add_argument('--history', default=None,
+        help="--metrics json file from a previous run, to estimate API requests per departure time search from")
+
+def budget_from_args(args):
+    if args.max_requests is None and args.max_cost is None:
+        return None
+    return RequestBudget(args.max_requests, args.max_cost, args.cost_per_request)
@@ -1,84 +1,569 @@
 from collections import defaultdict
 import os
+import sys
+import shutil
+import time
 import yaml
 import pytz
 import pickle
 import argparse
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 
-from commute_times import CommuteTimesClass
+from commute_times import CommuteTimesClass, DistanceMatrixClass, NoRouteError
 from load_config import load_config
+from rate_limit import RateLimiter
+from response_cache import add_cache_arguments, cache_from_args
+from transports import add_transport_arguments, transport_from_args
+from metrics import Metrics, Profiler, add_metrics_arguments
+from budget import (BudgetExceeded, DEFAULT_SOLVE_REQUESTS, add_budget_arguments, budget_from_args,
+    estimate_point_requests, print_estimate, solve_requests_from_metrics)
+from grid_io import GridCheckpoint, GridFile, BASE_COLUMNS, merge_grids, load_checkpoint
+from adaptive_grid import adaptive_sample, fine_lattice_size
+from boundary_mask import boundary_mask, add_boundary_arguments
+from geocode import add_geocode_arguments, geocode_cache_from_args
 
 ## all of CA:
 # northern_limit, western_limit = [42.263522, -125.653625]
 # southern_limit, eastern_limit = [32.543199, -114.048381]
 
-def main():
+## the days and traffic models every grid point is evaluated for
+YEAR, MONTH, FIRST_DAY, NDAYS = 2019, 8, 7, 2
+MODELS = ['best_guess']
+
+def finish_run(args, metrics, profiler, elapsed, interrupted=False):
+    """
+    report (and optionally write out) the run's metrics, and stop profiling
+    """
+    print(metrics.report())
+    if args.metrics is not None:
+        cells = metrics.counters['cells']
+        metrics.write(args.metrics, extra=dict(outname=args.outname, npts=args.npts, 
+            backend=args.backend, nworkers=args.nworkers, adaptive=args.adaptive,
+            interrupted=interrupted, wall_seconds=elapsed,
+            requests_per_cell=metrics.counters['requests']/cells if cells else None))
+        print(f"Wrote metrics to {args.metrics}")
+    if profiler is not None:
+        profiler.stop()
+
+def column_provenance(commutes, precision=None, geocode=False):
+    """
+    what went into each commute column (whose commute, to where, at what
+    time, over which days and models, and how addresses were turned into
+    queries), so --update can tell which columns are out of date when the 
+    config or the options change
+    """
+    provenance = {}
+    for name, info in commutes.items():
+        common = dict(name=name, address=info['address'], year=YEAR, month=MONTH, 
+            first_day=FIRST_DAY, ndays=NDAYS, models=MODELS, reduction='mean')
+        ## only recorded when they're not the defaults, so grids from before
+        ## these options existed are still up to date
+        if precision is not None:
+            common.update(precision=precision)
+        if geocode:
+            common.update(geocode=True)
+        provenance[f'{name}_towork'] = dict(common, direction='towork', 
+            hour=info['arrival_hour'], minute=info['arrival_minute'])
+        provenance[f'{name}_tohome'] = dict(common, direction='tohome', 
+            hour=info['departure_hour'], minute=info['departure_minute'])
+    return provenance
+
+def write_updated_grid(path, old_grid, columns, todo_columns, results, meta):
+    """
+    rewrite the grid at path with the current columns:  the ones that 
+    haven't changed are copied from old_grid, and todo_columns come from 
+    results (checkpoint records by cell).  cells that couldn't be updated 
+    because they have no route are marked failed; cells that haven't been
+    done yet (e.g. we ran out of budget) get NaNs
+    """
+    old = np.array(old_grid.cells)
+    tmp = path + '.updating'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    grid = GridFile.create(tmp, columns, meta)
+
+    rows = np.zeros(len(old), dtype=grid.dtype)
+    for key, _ in BASE_COLUMNS:
+        rows[key] = old[key]
+    for column in columns:
+        rows[column] = np.nan if column in todo_columns else old[column]
+    for ii, cell in enumerate(old['cell']):
+        record = results.get(int(cell))
+        if record is None:
+            continue
+        if record['result'] is None:
+            rows['failed'][ii] = True
+            continue
+        for column in todo_columns:
+            rows[column][ii] = record['result'][column]
+    grid.append(rows)
+
+    ## swap the new grid in only once it's complete
+    os.rename(path, path + '.old')
+    os.rename(tmp, path)
+    shutil.rmtree(path + '.old')
+    return GridFile(path)
+
+def tile_mask(nside, shards, tile):
+    """
+    which points of the nside x nside lattice are in tile number tile, 
+    when the lattice is split into shards x shards tiles (tiles are 
+    numbered across longitude first, then latitude)
+    """
+    ix_range = np.array_split(np.arange(nside), shards)[tile // shards]
+    iy_range = np.array_split(np.arange(nside), shards)[tile % shards]
+    in_tile = np.zeros((nside, nside), dtype=bool)
+    in_tile[ix_range[0]:ix_range[-1] + 1, iy_range[0]:iy_range[-1] + 1] = True
+    ## points are numbered ix*nside + iy
+    return in_tile.ravel()
+
+def shard_filename(filename, tile):
+    ## e.g. run.json -> run.tile3.json
+    base, ext = os.path.splitext(filename)
+    return f'{base}.tile{tile}{ext}'
+
+def run_shard(argv, logname):
+    ## runs in a worker process, with the output going to logname
+    import contextlib
+    with open(logname, 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        CommuteTimes = main(argv)
+    return CommuteTimes.metrics.counters['requests']
+
+def split_budget(total, weights, integer=False):
+    """
+    split total between tiles in proportion to weights (e.g. how many 
+    points each one has).  with integer, the shares are whole numbers that
+    still add up to total (largest remainders get the leftovers)
+    """
+    weights = np.asarray(weights, dtype=float)
+    shares = total*weights/weights.sum() if weights.sum() else np.zeros(len(weights))
+    if not integer:
+        return [float(share) for share in shares]
+    whole = np.floor(shares).astype(int)
+    leftover = int(total - whole.sum())
+    if leftover > 0 and weights.sum():
+        whole[np.argsort(whole - shares)[:leftover]] += 1
+    return [int(share) for share in whole]
+
+def run_shards(args, argv, nkeys, mask, nside):
+    """
+    split the grid into args.shards x args.shards tiles, and run each in a
+    separate process (args.nprocs at a time) with build_commute_grid.py 
+    --tile, writing to <outname>.shards/tile_<n>.  then merge the shards 
+    into outname.  points keep the same ids in every tile, so any tile can
+    be rerun on its own (with --tile) and merged again with merge_grids.py.
+    any budget is split between the tiles by how many (masked) points they 
+    have
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    shard_dir = args.outname + '.shards'
+    os.makedirs(shard_dir, exist_ok=True)
+    ntiles = args.shards**2
+
+    ## processes that share an API key share its rate limit too
+    nprocs = min(args.nprocs, ntiles)
+    max_qps = args.max_qps / -(-nprocs // nkeys)
+
+    argv = list(argv)
+    argv.remove(args.outname)
+    shards = [os.path.join(shard_dir, f'tile_{tile}') for tile in range(ntiles)]
+    tile_argv = [[shard] + argv + ['--tile', str(tile), '--max_qps', str(max_qps)] for tile, shard in enumerate(shards)]
+
+    ## the budget is for the whole run, so each tile gets a share of it in
+    ## proportion to its points (like --max_qps, the last value on the 
+    ## command line wins)
+    npoints = [np.count_nonzero(mask & tile_mask(nside, args.shards, tile)) for tile in range(ntiles)]
+    if args.max_requests is not None:
+        for tile, share in enumerate(split_budget(args.max_requests, npoints, integer=True)):
+            tile_argv[tile] += ['--max_requests', str(share)]
+    if args.max_cost is not None:
+        for tile, share in enumerate(split_budget(args.max_cost, npoints)):
+            tile_argv[tile] += ['--max_cost', str(share)]
+
+    print(f"Running {ntiles} tiles in {nprocs} processes; logs are in {shard_dir}/")
+    requests = 0
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        futures = {executor.submit(run_shard, tile_argv[tile], shard + '.log'): shard 
+            for tile, shard in enumerate(shards)}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Tiles"):
+            ## a tile that fails is reported but doesn't stop the others
+            try:
+                requests += future.result()
+            except Exception as e:
+                print(f"{futures[future]} failed (see {futures[future]}.log): {e!r}")
+
+    done = [shard for shard in shards if os.path.exists(os.path.join(shard, 'meta.json'))]
+    if len(done) < len(shards):
+        print(f"Only {len(done)} of {len(shards)} tiles finished; rerun with --resume to finish the rest")
+    if not len(done):
+        return None
+    grid = merge_grids(done, args.outname)
+    print(f"Merged {len(done)} tiles into {len(grid)} cells in {args.outname}; made {requests} API requests")
+    return grid
+
+def estimate_run(args, CommuteTimes, commutes, timezone, mask, nside, checkpoint_meta, columns=None):
+    """
+    print the expected number and cost of API requests for the run (for
+    --dry_run), without making any.  with --resume, points already in the
+    checkpoint (which must match checkpoint_meta) are left out.  columns 
+    limits the estimate to some of the commutes (for --update)
+    """
+    solve_requests = DEFAULT_SOLVE_REQUESTS
+    if args.history is not None:
+        solve_requests = solve_requests_from_metrics(args.history)
+        print(f"Using {solve_requests:.2f} API requests per departure time search from {args.history}")
+    plan = CommuteTimes.plan_commute_queries('grid point', commutes, YEAR, MONTH, FIRST_DAY, NDAYS, 
+        timezone, MODELS, columns=columns)
+    point_requests = estimate_point_requests(plan, solve_requests)
+
+    done = set()
+    if args.resume and os.path.exists(args.checkpoint):
+        done = set(load_checkpoint(args.checkpoint, checkpoint_meta))
+    todo = [ii for ii in np.flatnonzero(mask) if ii not in done]
+    if len(done):
+        print(f"Skipping {len(done)} points that are already in {args.checkpoint}")
+
+    if args.adaptive:
+        ## the starting grid is certain; how much gets refined isn't
+        stride = 2**args.max_depth
+        coarse = [ix*nside + iy for ix in range(0, nside, stride) for iy in range(0, nside, stride)]
+        coarse = [ii for ii in coarse if mask[ii] and ii not in done]
+        print_estimate(len(coarse), point_requests, args.cost_per_request, label="points in the starting grid")
+        most = len(todo) if args.max_points is None else min(len(todo), args.max_points)
+        print_estimate(most, point_requests, args.cost_per_request, args.max_qps, 
+            label="points if everything is refined")
+    else:
+        print_estimate(len(todo), point_requests, args.cost_per_request, args.max_qps)
+    if args.backend == 'matrix':
+        print("(the matrix backend makes fewer requests, but is billed for about as many elements)")
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument('outname')
+    parser.add_argument('outname', help="Directory to write the grid to (or a .pkl file for the old pickle format)")
     parser.add_argument('-c', '--config_filename', dest='config_filename', help="Config file with private info", default=None)
-    parser.add_argument('--state_name', default="California", help="State to use for the boundary to distinguish land from water.  Points outside the state are discarded")
     parser.add_argument('--npts', default=25, type=int, help="Number of points on each side of the grid (i.e. will use npts**2 points total)")
     parser.add_argument('--northern_limit', default=34.219498, type=float)
     parser.add_argument('--southern_limit', default=33.816168, type=float)
     parser.add_argument('--eastern_limit', default=-118.254013, type=float)
     parser.add_argument('--western_limit', default=-118.606110, type=float)
+    parser.add_argument('--nworkers', default=1, type=int, help="Number of grid points to query concurrently")
+    parser.add_argument('--max_qps', default=50, type=float, help="Maximum number of API requests per second (across all workers)")
+    parser.add_argument('--max_retries', default=5, type=int, help="Number of times to retry a request that fails with 429/5xx or OVER_QUERY_LIMIT")
+    parser.add_argument('--timeout', default=10, type=float, help="Timeout (in seconds) for each API request")
+    parser.add_argument('--backend', default='directions', choices=['directions', 'matrix'],
+        help="Query the Directions API one route at a time, or batch grid points through the Distance Matrix API")
+    parser.add_argument('--api_root', default="https://maps.googleapis.com/maps/api/",
+        help="Root url of the maps API (e.g. to point at stub_server.py)")
+    parser.add_argument('--checkpoint', default=None,
+        help="File to log each finished grid point to (defaults to <outname>.checkpoint.jsonl)")
+    parser.add_argument('--resume', action='store_true',
+        help="Skip grid points that are already in the checkpoint file")
+    parser.add_argument('--adaptive', action='store_true',
+        help="Start from an npts x npts grid and only refine cells whose commutes straddle max_happy_commute or vary by more than tolerance")
+    parser.add_argument('--max_depth', default=3, type=int, help="Maximum number of times to subdivide a cell in adaptive mode")
+    parser.add_argument('--max_happy_commute', default=45, type=float, help="Threshold (minutes) to resolve the boundary of in adaptive mode")
+    parser.add_argument('--tolerance', default=10, type=float, help="Refine cells whose corners differ by more than this many minutes in adaptive mode")
+    parser.add_argument('--max_points', default=None, type=int, help="Maximum number of points to query in adaptive mode")
+    add_boundary_arguments(parser)
+    add_cache_arguments(parser)
+    add_transport_arguments(parser)
+    add_geocode_arguments(parser)
+    add_metrics_arguments(parser)
+    add_budget_arguments(parser)
+    parser.add_argument('--shards', default=None, type=int,
+        help="Split the grid into shards x shards tiles, each run in its own process and merged at the end")
+    parser.add_argument('--nprocs', default=4, type=int, help="Number of tiles to run at once with --shards")
+    parser.add_argument('--tile', default=None, type=int, 
+        help="Only run this tile (0 to shards**2 - 1) of the grid; used by --shards, or to rerun a single tile")
+    parser.add_argument('--update', action='store_true',
+        help="Update an existing grid at outname, only querying the commutes that are new or changed in the config")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.update and (args.adaptive or args.outname.rsplit('.', 1)[-1] in ['pkl', 'pickle']):
+        parser.error("--update only works on uniform grids written as grid directories")
+    if args.shards is not None:
+        if args.adaptive:
+            parser.error("--shards can't be combined with --adaptive")
+        if args.outname.rsplit('.', 1)[-1] in ['pkl', 'pickle']:
+            parser.error("--shards writes grid directories, not pickles")
+        if args.tile is not None and not 0 <= args.tile < args.shards**2:
+            parser.error(f"--tile must be between 0 and {args.shards**2 - 1}")
+    elif args.tile is not None:
+        parser.error("--tile requires --shards")
 
-    config, timezome = load_config(args.config_filename)
-    CommuteTimes = CommuteTimesClass(key=config['api_key'])
-    commutes = config['commutes']
+    if args.tile is not None:
+        ## keep each tile's files separate
+        for key in ['checkpoint', 'metrics', 'profile']:
+            if getattr(args, key) is not None:
+                setattr(args, key, shard_filename(getattr(args, key), args.tile))
+    if args.checkpoint is None:
+        args.checkpoint = args.outname + ('.update' if args.update else '') + '.checkpoint.jsonl'
+
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler(args.profile)
+        profiler.start()
+
+    config, timezone = load_config(args.config_filename)
 
-    xv = np.linspace(args.western_limit, args.eastern_limit, args.npts)
-    yv = np.linspace(args.southern_limit, args.northern_limit, args.npts)
+    ## in adaptive mode, points live on the finest lattice we can refine to
+    nside = fine_lattice_size(args.npts, args.max_depth) if args.adaptive else args.npts
+    xv = np.linspace(args.western_limit, args.eastern_limit, nside)
+    yv = np.linspace(args.southern_limit, args.northern_limit, nside)
     pairs = np.array(np.meshgrid(xv, yv)).T.reshape(-1, 2)
     xvals, yvals = pairs.T
 
-    if args.state_name.lower() != 'none':
-        import shapely.vectorized
-        import shapely.geometry as sgeom
-        import cartopy.io.shapereader as shpreader
+    mask = boundary_mask(xvals, yvals, 
+        (args.western_limit, args.southern_limit, args.eastern_limit, args.northern_limit), nside,
+        state_name=None if args.state_name.lower() == 'none' else args.state_name, 
+        geojson=args.geojson, cache_dir=args.boundary_cache, simplify=args.simplify)
 
-        shpfilename = shpreader.natural_earth(resolution='10m',
-                                              category='cultural',
-                                              name='admin_1_states_provinces')
-        reader = shpreader.Reader(shpfilename)
-        states = list(reader.records())
+    ## with --shards, each tile gets the next key in api_keys (if given).  the
+    ## mask is computed (and cached) here first, so the tiles all find it in
+    ## the cache rather than racing to compute it
+    api_keys = config.get('api_keys', [config['api_key']])
+    if args.shards is not None and args.tile is None and not args.dry_run:
+        return run_shards(args, sys.argv[1:] if argv is None else argv, len(api_keys), mask, nside)
+    api_key = api_keys[args.tile % len(api_keys)] if args.tile is not None else config['api_key']
 
-        state, = [state for state in states if state.attributes['name'] == args.state_name]
-        geom = state.geometry
+    metrics = Metrics()
+    budget = budget_from_args(args)
+    backend = DistanceMatrixClass if args.backend == 'matrix' else CommuteTimesClass
+    CommuteTimes = backend(key=api_key, api_root=args.api_root, 
+        cache=cache_from_args(args), offline=args.offline,
+        rate_limiter=RateLimiter(args.max_qps), transport=transport_from_args(args, max(10, args.nworkers)),
+        timeout=args.timeout, max_retries=args.max_retries, metrics=metrics, budget=budget,
+        geocode=args.geocode, geocode_cache=geocode_cache_from_args(args), precision=args.precision)
+    commutes = config['commutes']
 
-        mask = shapely.vectorized.contains(geom, xvals, yvals)
-    else:
-        mask = np.ones(xvals.size, dtype=bool)
+    if args.tile is not None:
+        mask &= tile_mask(nside, args.shards, args.tile)
 
-    result = defaultdict(list)
-    names = commutes.keys()
+    meta = dict(northern_limit=args.northern_limit, southern_limit=args.southern_limit,
+        eastern_limit=args.eastern_limit, western_limit=args.western_limit,
+        npts=args.npts, state_name=args.state_name)
+    if args.geojson is not None:
+        meta.update(geojson=os.path.abspath(args.geojson))
+    if args.adaptive:
+        meta.update(max_depth=args.max_depth)
+    if args.tile is not None:
+        meta.update(shards=args.shards, tile=args.tile)
 
-    for ii, (ll, la) in enumerate(tqdm(pairs)):
-        if mask[ii]:
-            try:
-                address = f'{la},{ll}'
+    columns = [f'{name}_{destkey}' for name in commutes for destkey in ['towork', 'tohome']]
+    provenance = column_provenance(commutes, precision=args.precision, geocode=args.geocode)
+    todo_columns = None
+    checkpoint_meta = meta
+    if args.update:
+        ## only query the columns that are new or were made with a different
+        ## config, for the points that are already in the grid
+        if not os.path.exists(os.path.join(args.outname, 'meta.json')):
+            parser.error(f"No grid at {args.outname} to update")
+        old_grid = GridFile(args.outname)
+        old_meta = {key: old_grid.meta.get(key) for key in meta}
+        if old_meta != meta:
+            parser.error(f"{args.outname} was built for a different grid:\n    {old_meta}\nvs\n    {meta}")
+        old_provenance = old_grid.meta.get('provenance', {})
+        todo_columns = [column for column in columns if old_provenance.get(column) != provenance[column]]
+        dropped = [column for column in old_grid.columns if column not in columns]
+        print(f"Keeping {len(columns) - len(todo_columns)} columns, updating {len(todo_columns)}" + 
+              (f" ({', '.join(todo_columns)})" if len(todo_columns) else "") + 
+              (f", and dropping {', '.join(dropped)}" if len(dropped) else ""))
+
+        old_cells = old_grid.cells
+        update_mask = np.zeros(mask.size, dtype=bool)
+        update_mask[old_cells['cell'][~old_cells['failed']]] = True
+        mask &= update_mask
+        if not len(todo_columns):
+            mask[:] = False
+        checkpoint_meta = dict(meta, update={column: provenance[column] for column in todo_columns})
+
+    if args.dry_run:
+        try:
+            estimate_run(args, CommuteTimes, commutes, timezone, mask, nside, checkpoint_meta, columns=todo_columns)
+        except ValueError as e:
+            parser.error(str(e))
+        return CommuteTimes
 
-                res = CommuteTimes.get_commute_times(address, commutes, 
-                    2019, 8, 7, 2, timezone, models=['best_guess'], 
+    try:
+        checkpoint = GridCheckpoint(args.checkpoint, checkpoint_meta, resume=args.resume)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.resume:
+        print(f"Resuming from {args.checkpoint}: {len(checkpoint.cells)} points already done")
 
-                    do_print=False, do_pbar=False)
+    failures = []
+    plans = []
+    def evaluate(ii):
+        ll, la = pairs[ii]
+        if budget is not None and budget.exceeded:
+            ## out of budget; leave the rest for --resume
+            return
+        start = time.perf_counter()
+        try:
+            address = f'{la},{ll}'
 
-                result['lat'].append(la)
-                result['long'].append(ll)
-                for key in res:
-                    result[key].append(res[key])
-            except ValueError:
-                pass
+            res = CommuteTimes.get_commute_times(address, commutes, 
+                YEAR, MONTH, FIRST_DAY, NDAYS, timezone, models=MODELS, 
+                do_print=False, do_pbar=False, columns=todo_columns)
+        except BudgetExceeded:
+            ## not this point's fault, so leave it for --resume too
+            return
+        except NoRouteError as e:
+            ## no route (e.g. an island), which won't change on a rerun
+            failures.append((la, ll, e))
+            metrics.count('cells_failed')
+            checkpoint.append(ii, la, ll, error=str(e).splitlines()[0])
+            return
+        except ValueError as e:
+            ## anything else (we gave up on retrying, a cache miss while 
+            ## offline, a bad key, ...) might work next time, so leave it 
+            ## out of the checkpoint and try again when we resume
+            failures.append((la, ll, e))
+            metrics.count('cells_failed')
+            return
+        plans.append(CommuteTimes.last_plan)
+        metrics.count('cells')
+        metrics.observe('cell_seconds', time.perf_counter() - start)
+        metrics.observe('cell_requests', CommuteTimes.last_plan['requests'])
+        checkpoint.append(ii, la, ll, result=res)
+
+    ## with --profile, make sure the worker threads are profiled too
+    executor = ThreadPoolExecutor(max_workers=args.nworkers, 
+        initializer=profiler.start if profiler is not None else None)
+    run_start = time.perf_counter()
+    def run_cells(cells):
+        ## cells are identified by their index into pairs; evaluate 
+        ## (concurrently) the ones that aren't already done
+        todo = [ii for ii in cells if mask[ii] and ii not in checkpoint]
+
+        ## with the matrix backend, fetch everything we can for all of the 
+        ## points up front, in as few requests as possible
+        CommuteTimes.prefetch_commutes([f'{pairs[ii][1]},{pairs[ii][0]}' for ii in todo],
+            commutes, YEAR, MONTH, FIRST_DAY, NDAYS, timezone, models=MODELS, columns=todo_columns)
+
+        futures = [executor.submit(evaluate, ii) for ii in todo]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
+        if budget is not None and budget.exceeded:
+            raise BudgetExceeded(budget.summary())
+
+    def evaluate_points(points):
+        ## for adaptive_sample:  points are (ix, iy) on the lattice
+        cells = [ix*nside + iy for ix, iy in points]
+        run_cells(cells)
+        return {point: checkpoint.cells[ii]['result'] if ii in checkpoint else None
+            for point, ii in zip(points, cells)}
+
+    try:
+        if args.adaptive:
+            leaves = adaptive_sample(evaluate_points, args.npts, args.max_depth, 
+                args.max_happy_commute, args.tolerance, max_points=args.max_points,
+                queryable=lambda point: mask[point[0]*nside + point[1]])
+        else:
+            run_cells(range(len(pairs)))
+    except KeyboardInterrupt:
+        executor.shutdown(wait=True, cancel_futures=True)
+        checkpoint.close()
+        print(f"\nInterrupted; {len(checkpoint.cells)} points are saved in {args.checkpoint}.  Rerun with --resume to continue.")
+        finish_run(args, metrics, profiler, time.perf_counter() - run_start, interrupted=True)
+        return CommuteTimes
+    except BudgetExceeded:
+        out_of_budget = True
+        executor.shutdown(wait=True, cancel_futures=True)
+        print(f"\n{budget.summary()}; {len(checkpoint.cells)} points are saved in {args.checkpoint}.  " + 
+              "Rerun with --resume (and a bigger budget) to continue.")
+        if args.adaptive:
+            ## the refinement isn't finished, so there are no cells to write yet
+            checkpoint.close()
+            finish_run(args, metrics, profiler, time.perf_counter() - run_start, interrupted=True)
+            return CommuteTimes
+    else:
+        out_of_budget = False
+    executor.shutdown()
+    checkpoint.close()
+
+    ## one record per cell, in the same (grid) order as the serial loop
+    dx, dy = xv[1] - xv[0], yv[1] - yv[0]
+    cells = []
+    if args.adaptive:
+        ## one (variable size) cell per leaf, with the average of its corners
+        for ix, iy, size, corners in leaves:
+            if not any(mask[(ix + jx)*nside + iy + jy] for jx in [0, size] for jy in [0, size]):
+                continue
+            cell = dict(cell=ix*nside + iy, lat=yv[iy] + size*dy/2, long=xv[ix] + size*dx/2, 
+                dlat=size*dy/2, dlong=size*dx/2)
+            corners = [c for c in corners if c is not None]
+            cell['failed'] = not len(corners)
+            for key in columns:
+                if len(corners):
+                    cell[key] = sum(c[key] for c in corners)/len(corners)
+            cells.append(cell)
+        print(f"Sampled {len(checkpoint.cells)} points for {len(cells)} cells " + 
+              f"(a uniform grid at the same resolution has {nside**2} points)")
+    elif not args.update:
+        for ii in sorted(checkpoint.cells):
+            record = checkpoint.cells[ii]
+            cell = dict(cell=ii, lat=record['lat'], long=record['long'], dlat=dy/2, dlong=dx/2,
+                failed=record['result'] is None)
+            cell.update(record['result'] or {})
+            cells.append(cell)
+
+    ## points with no route (e.g. islands) fail no matter what, but
+    ## anything else could work on a rerun
+    nretry = sum(not isinstance(error, NoRouteError) for _, _, error in failures)
+    ## every point we're going to get is in the output
+    complete = not out_of_budget and not nretry
+    if len(failures):
+        print(f"Failed to get commutes for {len(failures)} points ({nretry} could be retried; rerun with --resume to retry those):")
+        for la, ll, error in failures:
+            print(f"    {la:.6f},{ll:.6f}: {str(error).splitlines()[0]}")
+
+    if len(plans):
+        print(f"Planned {sum(p['planned'] for p in plans)} queries " + 
+              f"({sum(p['unique'] for p in plans)} unique) for {len(plans)} points;" +
+              f" made {sum(p['requests'] for p in plans)} API requests")
 
     print(f"Writing output to {args.outname}...")
-    with open(args.outname, 'wb') as out:
-        pickle.dump(result, out)
+    if args.update and not complete:
+        ## some cells still need updating, so the columns we were updating 
+        ## keep their old provenance (or none, if they're new); that way the
+        ## next --update (or --update --resume) picks them up again
+        provenance = {column: value for column, value in provenance.items() if column not in todo_columns}
+        provenance.update({column: old_provenance[column] for column in todo_columns if column in old_provenance})
+    grid_meta = dict(meta, year=YEAR, month=MONTH, first_day=FIRST_DAY, ndays=NDAYS, models=MODELS,
+        adaptive=args.adaptive, partial=out_of_budget, provenance=provenance, precision=args.precision)
+    if args.update:
+        write_updated_grid(args.outname, old_grid, columns, todo_columns, checkpoint.cells, grid_meta)
+    elif args.outname.rsplit('.', 1)[-1] in ['pkl', 'pickle']:
+        ## the old format:  a dict of lists, without the failed cells
+        result = defaultdict(list)
+        for cell in cells:
+            if cell['failed']:
+                continue
+            for key in ['lat', 'long'] + (['dlat', 'dlong'] if args.adaptive else []) + columns:
+                result[key].append(cell[key])
+        with open(args.outname, 'wb') as out:
+            pickle.dump(result, out)
+    else:
+        grid = GridFile.create(args.outname, columns, meta=grid_meta)
+        grid.append(cells)
+    if complete:
+        ## everything's in the output now, so the next run (e.g. with 
+        ## tweaked bounds, or the next --update) starts fresh
+        os.remove(args.checkpoint)
+    if CommuteTimes.cache is not None:
+        print(CommuteTimes.cache.summary())
+    if CommuteTimes.geocode_cache is not None:
+        print(CommuteTimes.geocode_cache.summary())
+    if budget is not None:
+        print(budget.summary())
+    finish_run(args, metrics, profiler, time.perf_counter() - run_start)
     print("Done!")
+    return CommuteTimes
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
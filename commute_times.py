@@ -1,13 +1,165 @@
 #!/usr/bin/env python3
 
+import time
+import bisect
+import random
+import warnings
+import threading
 import requests
 from datetime import datetime, timedelta
 
+from transports import HTTPTransport, normalize_request
+from metrics import Metrics
+from geocode import parse_latlng, format_latlng, normalize_address
+
+
+## HTTP status codes and API status strings that are worth retrying
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+RETRY_API_STATUSES = ['OVER_QUERY_LIMIT', 'UNKNOWN_ERROR']
+## transport errors that won't go away if we ask again (everything else that 
+## requests raises, e.g. connection resets and truncated bodies, is retried)
+NON_TRANSIENT_ERRORS = (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema,
+    requests.exceptions.InvalidSchema, requests.exceptions.URLRequired, requests.exceptions.InvalidHeader)
+## API status strings that mean there's no route, which won't change if we ask again
+NO_ROUTE_STATUSES = ['ZERO_RESULTS', 'NOT_FOUND']
+
+class APIError(ValueError):
+    """
+    raised when a request keeps failing (e.g. 429/5xx or OVER_QUERY_LIMIT)
+    after all of the retries have been used up
+    """
+    pass
+
+class NoRouteError(ValueError):
+    """
+    raised when the API answers, but there's no route between the two
+    addresses (e.g. one of them is on an island)
+    """
+    pass
+
+class CommuteProfile:
+    """
+    travel time along one route as a function of departure time, over a
+    window of the day:  linearly interpolated between the samples (a 
+    sorted list of (departure time, minutes)) that CommuteTimesClass 
+    collected along it
+    """
+    def __init__(self, samples):
+        self.times = [t for t, _ in samples]
+        self.minutes = [m for _, m in samples]
+        self.start, self.end = self.times[0], self.times[-1]
+
+    def covers(self, departure_time):
+        return self.start <= departure_time <= self.end
+
+    def __call__(self, departure_time):
+        """
+        minutes to get there leaving at departure_time
+        """
+        if not self.covers(departure_time):
+            raise ValueError(f"{departure_time} is outside of this profile ({self.start} to {self.end})")
+        ii = bisect.bisect_left(self.times, departure_time)
+        if self.times[ii] == departure_time:
+            return self.minutes[ii]
+        t0, t1 = self.times[ii-1], self.times[ii]
+        frac = (departure_time - t0)/(t1 - t0)
+        return self.minutes[ii-1] + frac*(self.minutes[ii] - self.minutes[ii-1])
+
+    def at(self, step=15):
+        """
+        [(departure time, minutes)] every step minutes across the window
+        """
+        result = []
+        departure_time = self.start
+        while departure_time <= self.end:
+            result.append((departure_time, self(departure_time)))
+            departure_time += timedelta(minutes=step)
+        return result
+
+    def depart_time(self, target_arrival_time, early_tolerance=7, late_tolerance=0):
+        """
+        when to leave to get there by target_arrival_time, aiming for the 
+        middle of the tolerance window like find_depart_time does, or None
+        if the answer isn't inside the profile.  arrival time only ever
+        increases with departure time, so there's only one answer
+        """
+        aim = (early_tolerance - late_tolerance)/2
+        wanted = target_arrival_time - timedelta(minutes=aim)
+        arrivals = [t + timedelta(minutes=m) for t, m in zip(self.times, self.minutes)]
+        ii = bisect.bisect_left(arrivals, wanted)
+        if ii == len(arrivals) or (ii == 0 and arrivals[0] != wanted):
+            return None
+        if arrivals[ii] == wanted:
+            return self.times[ii]
+        frac = (wanted - arrivals[ii-1])/(arrivals[ii] - arrivals[ii-1])
+        return self.times[ii-1] + frac*(self.times[ii] - self.times[ii-1])
+
 
 class CommuteTimesClass:
-    def __init__(self, key):
-        self.base = "https://maps.googleapis.com/maps/api/directions/json?"
+    def __init__(self, key, cache=None, offline=False, rate_limiter=None,
+        pool_size=10, timeout=10, max_retries=5, backoff=1.0, 
+        api_root="https://maps.googleapis.com/maps/api/", transport=None, metrics=None,
+        budget=None, geocode=False, geocode_cache=None, precision=None):
+        """
+        cache is an optional response_cache.ResponseCache; if offline is
+        True, then only cached responses are used and any request that
+        isn't in the cache raises a ValueError.
+
+        rate_limiter is an optional rate_limit.RateLimiter that every 
+        request to the API waits on (cached responses don't count), so 
+        the class can be shared between threads without going over quota.
+
+        requests are sent through transport (see transports.py), which 
+        defaults to a pooled keep-alive session with up to pool_size 
+        connections; each request times out after timeout seconds
+        and is retried up to max_retries times (waiting backoff*2**attempt
+        seconds, plus some jitter) on connection errors, 429/5xx responses,
+        and OVER_QUERY_LIMIT/UNKNOWN_ERROR statuses.
+
+        api_root can be pointed elsewhere (e.g. at stub_server.py) for testing.
+
+        request latencies, retries, cache hits, failures and so on are 
+        recorded in metrics (a metrics.Metrics, created if not given).
+
+        budget is an optional budget.RequestBudget that every request to 
+        the API (including retries) is charged to before it's sent; once 
+        it runs out, requests raise budget.BudgetExceeded.
+
+        if geocode is True, free-text addresses are resolved to coordinates 
+        with the Geocoding API (once each, and stored in geocode_cache, a 
+        geocode.GeocodeCache, if given) and we query with those instead.  
+        coordinates are rounded to precision decimal places if given.
+        """
+        self.api_root = api_root
+        self.base = api_root + "directions/json?"
         self.KEY = key
+        self.cache = cache
+        self.offline = offline
+        self.rate_limiter = rate_limiter
+        if offline and cache is None:
+            raise ValueError("Must provide a cache to run offline")
+
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.transport = transport if transport is not None else HTTPTransport(pool_size)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.budget = budget
+        self.geocode = geocode
+        self.geocode_cache = geocode_cache
+        self.precision = precision
+        ## {address: the address we actually query with}
+        self._canonical = {}
+
+        ## {(departure_address, arrival_address, traffic_model): {departure_time: minutes}}
+        self.samples = {}
+        ## {(departure_address, arrival_address, traffic_model): [CommuteProfile]}
+        self.profiles = {}
+        ## worker threads share samples and profiles (and can be working on
+        ## the same route at once), so everything that touches them holds this
+        self._samples_lock = threading.Lock()
+        ## per-thread request counts, for get_commute_times to report on
+        self._local = threading.local()
 
     def escaped_string(self, string):
         # return '+'.join(string.replace(',','').split())
@@ -17,6 +169,51 @@ class CommuteTimesClass:
         return str(int(dt.timestamp()))
         # return dt.strftime('%s')
 
+    def canonical(self, address):
+        """
+        the form of address we actually query with:  "lat,lng" (rounded to
+        self.precision places) if address is a "lat,lng" pair or we're 
+        geocoding, and the address as given otherwise
+        """
+        if address in self._canonical:
+            return self._canonical[address]
+
+        latlng = parse_latlng(address)
+        if latlng is None and self.geocode:
+            latlng = self.geocode_address(address)
+        result = address if latlng is None else format_latlng(*latlng, precision=self.precision)
+        self._canonical[address] = result
+        return result
+
+    def canonical_commutes(self, commutes):
+        return {name: dict(info, address=self.canonical(info['address'])) for name, info in commutes.items()}
+
+    def geocode_address(self, address):
+        """
+        (lat, lng) of a free-text address, from the geocode cache if we've
+        seen it (or another spelling of it) before
+        """
+        key = normalize_address(address)
+        if self.geocode_cache is not None:
+            latlng = self.geocode_cache.get(key)
+            if latlng is not None:
+                self.metrics.count('geocode_hits')
+                return latlng
+
+        if not len(self.KEY):
+            raise ValueError("Must provide a non-empty API key")
+        self.metrics.count('geocodes')
+        url = self.api_root + "geocode/json?address=" + self.escaped_string(address) + "&key=" + self.KEY
+        data = self.get_response(url)
+        if data.get('status') != 'OK' or not len(data.get('results', [])):
+            raise ValueError(f"Failed to geocode {address} ({data.get('status')})")
+
+        result = data['results'][0]
+        latlng = (result['geometry']['location']['lat'], result['geometry']['location']['lng'])
+        if self.geocode_cache is not None:
+            self.geocode_cache.put(key, *latlng, formatted_address=result.get('formatted_address'))
+        return latlng
+
     def build_url(self, departure_address, arrival_address, departure_time=None, arrival_time=None, traffic_model='best_guess'):
         if not len(self.KEY):
             raise ValueError("Must provide a non-empty API key")
@@ -26,8 +223,8 @@ class CommuteTimesClass:
         if departure_time is not None:
             assert arrival_time is None
 
-        url = self.base + "origin=" + self.escaped_string(departure_address)
-        url += "&destination=" + self.escaped_string(arrival_address)
+        url = self.base + "origin=" + self.escaped_string(self.canonical(departure_address))
+        url += "&destination=" + self.escaped_string(self.canonical(arrival_address))
         if departure_time is not None:
             url += "&departure_time=" + self.datetime_to_unix(departure_time)
             url += "&traffic_model="+traffic_model
@@ -37,20 +234,132 @@ class CommuteTimesClass:
         url += "&key="+self.KEY
         return url
 
+    def request_key(self, url):
+        """
+        normalize a url into a cache key:  drop the API key and sort the
+        query parameters so equivalent requests map to the same entry
+        """
+        return normalize_request(url)
+
+    def get_response(self, url, elements=1):
+        """
+        get the (decoded json) response for url, from the cache if possible.
+        elements is the number of routes the request is billed for
+        """
+        request = self.request_key(url)
+        if self.cache is not None:
+            data = self.cache.get(request)
+            if data is not None:
+                self.metrics.count('cache_hits')
+                return data
+            self.metrics.count('cache_misses')
+        if self.offline:
+            raise ValueError(f"No cached response for {request} (running offline)")
+
+        self._local.requests = getattr(self._local, 'requests', 0) + 1
+        data = self.fetch(url, elements=elements)
+
+        ## only cache answers that won't change if we ask again
+        if self.cache is not None and data.get('status', 'OK') in ['OK', 'ZERO_RESULTS', 'NOT_FOUND']:
+            self.cache.put(request, data)
+        return data
+
+    def fetch(self, url, elements=1):
+        """
+        query the API for url, retrying with exponential backoff on 
+        transient failures.  raises an APIError if we run out of retries
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.metrics.count('retries')
+                self.metrics.count(f'failures.{reason}')
+                time.sleep(self.backoff * 2**(attempt - 1) * (1 + random.random()))
+
+            if self.budget is not None:
+                self.budget.charge(elements)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            self.metrics.count('requests')
+            start = time.perf_counter()
+            try:
+                res = self.transport.get(url, timeout=self.timeout)
+            except NON_TRANSIENT_ERRORS as e:
+                raise ValueError(f"Bad request ({type(e).__name__}) with url:\n{self.request_key(url)}") from e
+            except requests.RequestException as e:
+                reason = type(e).__name__
+                continue
+            finally:
+                self.metrics.observe('request_seconds', time.perf_counter() - start)
+
+            if res.status_code in RETRY_STATUS_CODES:
+                reason = f"HTTP {res.status_code}"
+                continue
+            try:
+                res.raise_for_status()
+            except Exception as e:
+                self.metrics.count(f'failures.HTTP {res.status_code}')
+                raise ValueError(f"Caught exception ", e, "with url\n", url)
+            # if res.response != 200:
+            #     raise ValueError(f"Invalid response code for following url:\n{url}")
+
+            data = res.json()
+            status = data.get('status', 'OK')
+            if status in RETRY_API_STATUSES:
+                reason = status
+                continue
+            if status != 'OK':
+                self.metrics.count(f'failures.{status}')
+            return data
+
+        self.metrics.count(f'failures.{reason}')
+        self.metrics.count('gave_up')
+        raise APIError(f"Giving up after {self.max_retries + 1} attempts ({reason}) with url:\n{self.request_key(url)}")
+
+    def lookup_sample(self, route, departure_time):
+        """
+        minutes along route (departure_address, arrival_address, traffic_model)
+        leaving at departure_time, if we've sampled it, otherwise None
+        """
+        with self._samples_lock:
+            return self.samples.get(route, {}).get(departure_time)
+
+    def add_sample(self, route, departure_time, minutes):
+        with self._samples_lock:
+            self.samples.setdefault(route, {})[departure_time] = minutes
+
+    def sample_items(self, route):
+        """
+        [(departure time, minutes)] sampled along route so far (a copy, so 
+        it's safe to loop over while other threads add samples)
+        """
+        with self._samples_lock:
+            return list(self.samples.get(route, {}).items())
+
     def get_estimated_time(self, departure_address, arrival_address, **kwargs):
+        ## travel times at a given departure time are remembered (by route and
+        ## model) so that searches on other days/models can start from them
+        departure_time = kwargs.get('departure_time')
+        route = (departure_address, arrival_address, kwargs.get('traffic_model', 'best_guess'))
+        if departure_time is not None:
+            travel_time = self.lookup_sample(route, departure_time)
+            if travel_time is not None:
+                self.metrics.count('sample_hits')
+                return travel_time
+
         url = self.build_url(departure_address, arrival_address, **kwargs)
-        res = requests.get(url)
-        try:
-            res.raise_for_status()
-        except Exception as e:
-            raise ValueError(f"Caught exception ", e, "with url\n", url)
-        # if res.response != 200:
-        #     raise ValueError(f"Invalid response code for following url:\n{url}")
+        data = self.get_response(url)
+        status = data.get('status', 'OK')
+        if status in NO_ROUTE_STATUSES or (status == 'OK' and not len(data.get('routes', []))):
+            self.metrics.count('failures.no_route')
+            raise NoRouteError(f"No route from {departure_address} to {arrival_address} ({status}) with url:\n{self.request_key(url)}")
         try:
-            travel_time = res.json()['routes'][0]['legs'][0]['duration_in_traffic']['value']/60
-        except IndexError:
-            raise ValueError(f"Failed to get a route from {departure_address} to {arrival_address} with url:\n{url}")
+            travel_time = data['routes'][0]['legs'][0]['duration_in_traffic']['value']/60
+        except (IndexError, KeyError):
+            ## e.g. REQUEST_DENIED, which is our problem rather than the route's
+            raise ValueError(f"Failed to get a route from {departure_address} to {arrival_address} ({status}) with url:\n{self.request_key(url)}")
 
+        if departure_time is not None:
+            self.add_sample(route, departure_time, travel_time)
         return travel_time
 
     def find_depart_time(self, departure_address, arrival_address, target_arrival_time, 
@@ -65,7 +374,31 @@ class CommuteTimesClass:
             willing to be there; late_tolerance is how late you're
             willing to be there (both positive)
 
+        the search works on the lead time (minutes between leaving and the
+        target arrival time), aiming for the middle of the tolerance window.
+        the first step uses the observed duration_in_traffic directly (i.e.
+        leave that long before the target), after which we use the secant
+        method, switching to Illinois-style regula falsi once we've bracketed
+        the answer.  initial_step (shrinking to min_step) is only used if
+        the secant step is unusable.  if we've already seen this route 
+        (on another day or with another model), we start from those samples
+        rather than from guess.
+
+        if we've already built a profile of the route (see 
+        get_commute_profile) that covers the answer, it's read off of the 
+        profile without making any requests.
         """
+        traffic_model = kwargs.get('traffic_model', 'best_guess')
+        aim = (early_tolerance - late_tolerance)/2
+
+        with self._samples_lock:
+            profiles = list(self.profiles.get((departure_address, arrival_address, traffic_model), []))
+        for profile in profiles:
+            departure_time = profile.depart_time(target_arrival_time, early_tolerance, late_tolerance)
+            if departure_time is not None:
+                self.metrics.count('profile_hits')
+                return departure_time
+
         def get_departure_from_guess(this_guess):
             dt = timedelta(minutes=this_guess)
             return target_arrival_time - dt
@@ -75,41 +408,206 @@ class CommuteTimesClass:
             travel_time = self.get_estimated_time(departure_address, 
                 arrival_address, departure_time=this_time, **kwargs)
 
-            arrival_time = this_time + timedelta(minutes=travel_time)
-
             ## if positive, then target_arrival_time is later, which means
             ## we get there earlier than we want, which isn't ideal but is ok.
 
             ## if negative, then we're getting there late, which isn't ok
-            # print(f"guess = {guess}, departure = {this_time}," + 
-            #       f" travel = {travel_time}, arrival = {arrival_time}," + 
-            #       f" target = {target_arrival_time}")
+            return this_guess - travel_time, travel_time
 
-            return (target_arrival_time - arrival_time).total_seconds()/60
+        def acceptable(difference):
+            return -1*abs(late_tolerance) <= difference <= early_tolerance
 
-        difference = get_difference(guess)
+        requests_before = getattr(self._local, 'requests', 0)
+        guess = round(self.estimate_lead(departure_address, arrival_address, 
+            target_arrival_time, traffic_model, aim, default=guess))
+        difference, travel_time = get_difference(guess)
+        calls = 1
 
+        ## (guess, difference - aim) for the previous point, and the last
+        ## point on the other side of the aim (once we've bracketed it)
+        previous = None
+        bracket = None
         step = initial_step
-        calls = 1
-        while (difference < -1*abs(late_tolerance)) or (difference > early_tolerance):
-            # print(f"difference = {difference}\n\n")
-            if difference > 0:
-                ## target is greater than actual => we got there too early
-                ## so leave later, which means use a smaller guess
-                guess = guess - step
-            else:
-                ## target is less than actual, so we got there too late =>  leave earlier
-                guess = guess + step
-            difference = get_difference(guess)
-            step = max(min_step, 0.75*step)
+        while not acceptable(difference):
+            if calls >= max_calls:
+                self.metrics.count('solves_unconverged')
+                warnings.warn(f"Departure time search gave up after {calls} tries -- last difference is {difference}",
+                    RuntimeWarning)
+                break
 
+            residual = difference - aim
+            if previous is None:
+                ## leave as long before the target as the trip just took
+                new_guess = travel_time + aim
+            else:
+                if residual * previous[1] < 0:
+                    bracket = previous
+                elif bracket is not None:
+                    ## Illinois: same side twice in a row, so halve the 
+                    ## weight of the retained end of the bracket
+                    bracket = (bracket[0], bracket[1]/2)
+                other = bracket if bracket is not None else previous
+
+                ## difference always increases with the lead time (leaving
+                ## earlier never gets you there later), so anything else 
+                ## means the secant step can't be trusted
+                slope = (residual - other[1])/(guess - other[0]) if guess != other[0] else 0
+                if slope > 0:
+                    new_guess = guess - residual/slope
+                else:
+                    new_guess = guess - step if residual > 0 else guess + step
+                    step = max(min_step, 0.75*step)
+
+            previous = (guess, residual)
+            new_guess = round(new_guess)
+            if new_guess == guess:
+                ## can't resolve better than a minute; nudge in the right direction
+                new_guess = guess - 1 if residual > 0 else guess + 1
+            guess = new_guess
+            difference, travel_time = get_difference(guess)
             calls += 1
-            if calls > max_calls:
-                print(f"Too many calls -- last difference is {difference}")
-                break
 
+        self.metrics.count('solves')
+        self.metrics.observe('solve_iterations', calls)
+        self.metrics.observe('solve_requests', getattr(self._local, 'requests', 0) - requests_before)
         return get_departure_from_guess(guess)
 
+    def estimate_lead(self, departure_address, arrival_address, target_arrival_time, 
+        traffic_model, aim, default):
+        """
+        estimate how long before target_arrival_time to leave from samples
+        we've already collected along this route, preferring samples from
+        the same traffic model and the closest time of day (across days).
+        returns default if we haven't seen the route before.
+        """
+        def minute_of_day(dt):
+            dt = dt.astimezone(target_arrival_time.tzinfo)
+            return dt.hour*60 + dt.minute + dt.second/60
+
+        target_minute = minute_of_day(target_arrival_time)
+        best = None
+        for model in [traffic_model] + [m for m in ['best_guess', 'pessimistic', 'optimistic'] if m != traffic_model]:
+            for departure_time, travel_time in self.sample_items((departure_address, arrival_address, model)):
+                distance = abs(minute_of_day(departure_time + timedelta(minutes=travel_time)) - target_minute)
+                if best is None or distance < best[0]:
+                    best = (distance, travel_time)
+            if best is not None:
+                return best[1] + aim
+        return default
+
+
+    def forget_address(self, address):
+        """
+        drop the samples and profiles for every route to or from address, 
+        e.g. once we're done with it, so memory doesn't grow with the 
+        number of addresses we've looked at
+        """
+        address = self._canonical.pop(address, address)
+        with self._samples_lock:
+            for store in [self.samples, self.profiles]:
+                for key in list(store):
+                    if address in key[:2]:
+                        store.pop(key, None)
+
+    def route_samples(self, departure_address, arrival_address, traffic_model, start, end):
+        """
+        sorted [(departure time, minutes)] we've sampled along a route 
+        between start and end
+        """
+        samples = self.sample_items((departure_address, arrival_address, traffic_model))
+        return sorted((t, m) for t, m in samples if start <= t <= end)
+
+    def get_commute_profile(self, departure_address, arrival_address, start, end, 
+        traffic_model='best_guess', step=15, max_gap=60, tolerance=1):
+        """
+        travel time as a function of departure time between start and end
+        (datetimes), as a CommuteProfile.  
+
+        rather than querying every step minutes, we start from whatever 
+        we've already sampled along the route in the window (e.g. during 
+        find_depart_time searches) plus the two ends, then keep splitting
+        any gap between samples that's longer than max_gap minutes, or 
+        longer than step minutes where linear interpolation looks like 
+        it's off by more than tolerance minutes (judging by the curvature 
+        at either end), until none are left.  everything in between is 
+        interpolated.  the profile is kept, so later find_depart_time 
+        calls on the route can be answered from it
+        """
+        def sample(departure_time):
+            self.get_estimated_time(departure_address, arrival_address, 
+                departure_time=departure_time, traffic_model=traffic_model)
+
+        sample(start)
+        sample(end)
+        while True:
+            samples = self.route_samples(departure_address, arrival_address, traffic_model, start, end)
+            times = [(t - start).total_seconds()/60 for t, _ in samples]
+            minutes = [m for _, m in samples]
+
+            ## second derivative of travel time at each sample, from its neighbors
+            curvature = [0]*len(samples)
+            for ii in range(1, len(samples) - 1):
+                h0, h1 = times[ii] - times[ii-1], times[ii+1] - times[ii]
+                curvature[ii] = 2*((minutes[ii+1] - minutes[ii])/h1 - (minutes[ii] - minutes[ii-1])/h0)/(h0 + h1)
+            if len(samples) > 2:
+                curvature[0], curvature[-1] = curvature[1], curvature[-2]
+
+            todo = []
+            for ii in range(len(samples) - 1):
+                gap = times[ii+1] - times[ii]
+                error = gap**2/8 * max(abs(curvature[ii]), abs(curvature[ii+1]))
+                if gap > max(max_gap, step) or (gap > step and error > tolerance):
+                    todo.append(samples[ii][0] + timedelta(minutes=gap//2))
+            if not len(todo):
+                break
+            for departure_time in todo:
+                sample(departure_time)
+
+        profile = CommuteProfile(samples)
+        with self._samples_lock:
+            self.profiles.setdefault((departure_address, arrival_address, traffic_model), []).append(profile)
+        return profile
+
+    def get_commute_profiles(self, address, commutes, year, month, first_day, ndays, timezone,
+        traffic_model='best_guess', before=120, after=60, step=15):
+        """
+        profiles of every commute to and from address, for departure times 
+        from before minutes before to after minutes after each person's 
+        usual arrival (to work) and departure (to home) times.  returns
+        {name: {'towork': {day: CommuteProfile}, 'tohome': {day: CommuteProfile}}}
+        """
+        address = self.canonical(address)
+        commutes = self.canonical_commutes(commutes)
+        profiles = {}
+        for name, info in commutes.items():
+            profiles[name] = {'towork': {}, 'tohome': {}}
+            for day in range(first_day, first_day + ndays):
+                arrival = timezone.localize(datetime(year, month, day, 
+                    hour=info['arrival_hour'], minute=info['arrival_minute']))
+                departure = timezone.localize(datetime(year, month, day, 
+                    hour=info['departure_hour'], minute=info['departure_minute']))
+                profiles[name]['towork'][day] = self.get_commute_profile(address, info['address'],
+                    arrival - timedelta(minutes=before), arrival + timedelta(minutes=after), 
+                    traffic_model=traffic_model, step=step)
+                profiles[name]['tohome'][day] = self.get_commute_profile(info['address'], address,
+                    departure - timedelta(minutes=before), departure + timedelta(minutes=after), 
+                    traffic_model=traffic_model, step=step)
+        return profiles
+
+    def print_profiles(self, profiles, timezone, step=15):
+        for name, directions in profiles.items():
+            for direction, label in [('towork', 'to work'), ('tohome', 'home')]:
+                days = sorted(directions[direction])
+                print()
+                string = f"{name}'s commute {label} (minutes) by departure time"
+                print(string)
+                print('-'*len(string))
+                print('leaving'.ljust(10) + ''.join(
+                    directions[direction][day].start.astimezone(timezone).strftime('%a %d').rjust(8) for day in days))
+                rows = [directions[direction][day].at(step) for day in days]
+                for ii in range(min(len(row) for row in rows)):
+                    departure = rows[0][ii][0].astimezone(timezone).strftime('%H:%M')
+                    print(departure.ljust(10) + ''.join(f'{row[ii][1]:8.0f}' for row in rows))
 
     def find_commute_to_work_length(self, departure_address, arrival_address, 
         target_arrival_time, **kwargs):
@@ -151,63 +649,247 @@ class CommuteTimesClass:
         for key in towork:
             subprint(towork[key], tohome[key], key)
 
+    def prefetch_commutes(self, addresses, commutes, year, month, first_day, ndays, timezone, 
+        models, guess=45, columns=None):
+        """
+        backends that can batch requests (see DistanceMatrixClass) use this 
+        to collect samples for many addresses at once before get_commute_times
+        works through them one at a time.  nothing to do for Directions.
+        """
+        pass
+
+    def plan_commute_queries(self, address, commutes, year, month, first_day, ndays, timezone, models,
+        columns=None):
+        """
+        enumerate every query get_commute_times needs, as a dict mapping
+        (name, direction, day, model) to a query tuple of 
+
+            ('towork', origin, destination, target arrival time, model) or
+            ('tohome', origin, destination, departure time, model)
+
+        so people who share a work address and arrival/departure time map
+        to the same query, which only has to be executed once.  if columns
+        is given, only the commutes named there (e.g. 'alice_towork') are
+        planned
+        """
+        plan = {}
+        for name, info in commutes.items():
+            for day in range(first_day, first_day + ndays):
+                arrival = timezone.localize(datetime(year, month, day, 
+                    hour=info['arrival_hour'], minute=info['arrival_minute']))
+                departure = timezone.localize(datetime(year, month, day, 
+                    hour=info['departure_hour'], minute=info['departure_minute']))
+                for model in models:
+                    plan[(name, 'towork', day, model)] = ('towork', address, info['address'], arrival, model)
+                    plan[(name, 'tohome', day, model)] = ('tohome', info['address'], address, departure, model)
+        if columns is not None:
+            plan = {key: query for key, query in plan.items() if f'{key[0]}_{key[1]}' in columns}
+        return plan
+
+    @property
+    def last_plan(self):
+        """
+        {'planned', 'unique', 'requests'} for the last get_commute_times call 
+        in this thread:  queries before and after removing duplicates, and 
+        the number of API requests it actually made
+        """
+        return getattr(self._local, 'last_plan', None)
+
     def get_commute_times(self, address, commutes, year, month, first_day, ndays, timezone, 
         models=['pessimistic', 'optimistic', 'best_guess'], do_print=True, do_pbar=True,
         return_model='best_guess', return_reduction=lambda x:  sum(x)/len(x), 
-        initial_guess_for_commute_length=45, initial_step=25):
-
+        initial_guess_for_commute_length=45, initial_step=25, columns=None):
+        """
+        commutes to and from address for everyone in commutes, reduced over 
+        the days with return_reduction, as {'<name>_towork': minutes, 
+        '<name>_tohome': minutes}.  pass columns to only work out some of 
+        those (e.g. ['alice_towork']).  with return_model=None, you get 
+        every model's minutes for each day instead, as 
+        {'<name>_towork': {model: [minutes, ...]}, ...}
+        """
         from collections import defaultdict
 
         towork = defaultdict(lambda: defaultdict(list))
         tohome = defaultdict(lambda: defaultdict(list))
+        requests_before = getattr(self._local, 'requests', 0)
 
-        if do_pbar:
-            from tqdm import tqdm
-            pbar = tqdm(total=len(commutes)*len(models)*ndays, desc="Commutes calculated")
-            count = 0
+        ## everything from here on uses the addresses we actually query with, 
+        ## so different spellings of the same place share samples and queries
+        address = self.canonical(address)
+        commutes = self.canonical_commutes(commutes)
 
-        for name, info in commutes.items():
-            for day in range(first_day, first_day + ndays):
-                for model in models:
-                    ## to work:
-                    time = timezone.localize(datetime(year, month, day, 
-                        hour=info['arrival_hour'], minute=info['arrival_minute']))
+        self.prefetch_commutes([address], commutes, year, month, first_day, ndays, timezone,
+            models, guess=initial_guess_for_commute_length, columns=columns)
 
-                    towork[name][model].append(
-                        self.find_commute_to_work_length(
-                            address, info['address'], time, traffic_model=model,
-                            guess=initial_guess_for_commute_length, initial_step=initial_step))
+        ## collapse duplicate queries, and solve the best_guess commute to work 
+        ## before the other models, so they can start from its answer
+        plan = self.plan_commute_queries(address, commutes, year, month, first_day, ndays, timezone, models, 
+            columns=columns)
+        queries = sorted(set(plan.values()), key=lambda q: q[:4] + (q[4] != 'best_guess', q[4]))
 
-                    ## to home
-                    time = timezone.localize(datetime(year, month, day, 
-                        hour=info['departure_hour'], minute=info['departure_minute']))
+        if do_pbar:
+            from tqdm import tqdm
+            pbar = tqdm(total=len(queries), desc="Commutes calculated")
+
+        answers = {}
+        best_guess_lengths = {}
+        for query in queries:
+            direction, origin, destination, time, model = query
+            if direction == 'towork':
+                guess = best_guess_lengths.get(query[:4], initial_guess_for_commute_length)
+                answers[query] = self.find_commute_to_work_length(
+                    origin, destination, time, traffic_model=model,
+                    guess=guess, initial_step=initial_step)
+                if model == 'best_guess':
+                    best_guess_lengths[query[:4]] = answers[query]
+            else:
+                answers[query] = self.get_estimated_time(
+                    origin, destination, departure_time=time, traffic_model=model)
 
-                    tohome[name][model].append(
-                        self.get_estimated_time(
-                            info['address'], address, departure_time=time, traffic_model=model))
+            if do_pbar:
+                ## update the progress bar
+                pbar.update()
 
-                    if do_pbar:
-                        ## update the progress bar
-                        pbar.update()
+        for (name, direction, day, model), query in plan.items():
+            if direction == 'towork':
+                towork[name][model].append(answers[query])
+            else:
+                tohome[name][model].append(answers[query])
 
+        self._local.last_plan = dict(planned=len(plan), unique=len(queries), 
+            requests=getattr(self._local, 'requests', 0) - requests_before)
 
-        if do_print:
+        if do_print and columns is None:
             string = f"Commutes from {address}"
             dots = "="*((80 - len(string))//2 - 2)
             print(dots + ' ' + string + ' ' + dots)
             self.pretty_print(towork, tohome, commutes)
+            print()
+            print(f"Planned {self.last_plan['planned']} queries ({self.last_plan['unique']} unique);" + 
+                  f" made {self.last_plan['requests']} API requests")
+
+        if return_model is None:
+            res = {name+'_towork': dict(towork[name]) for name in towork}
+            res.update({name+'_tohome': dict(tohome[name]) for name in tohome})
+            return res
 
-        if return_model is not None:
-            assert return_model in ['best_guess', 'optimistic', 'pessimistic']
+        assert return_model in ['best_guess', 'optimistic', 'pessimistic']
         res = {}
         for name in towork:
             res[name+'_towork'] = return_reduction(towork[name][return_model])
+        for name in tohome:
             res[name+'_tohome'] = return_reduction(tohome[name][return_model])
         return res
 
+class DistanceMatrixClass(CommuteTimesClass):
+    """
+    backend that uses the Distance Matrix API to get travel times for many
+    origins and destinations in a single request (up to 25 origins, 25 
+    destinations, and 100 elements per request).  the matrix API can't
+    search on arrival time, so prefetch_commutes fetches all of the commutes
+    home and the first guess for each commute to work in batches, and the 
+    remaining steps of the to-work search go through the Directions API.
+
+    note that the Distance Matrix API bills per element, not per request.
+    """
+    max_origins = 25
+    max_destinations = 25
+    max_elements = 100
+
+    def __init__(self, key, **kwargs):
+        super().__init__(key, **kwargs)
+        self.matrix_base = self.api_root + "distancematrix/json?"
+
+    def build_matrix_url(self, origins, destinations, departure_time, traffic_model='best_guess'):
+        if not len(self.KEY):
+            raise ValueError("Must provide a non-empty API key")
+
+        url = self.matrix_base + "origins=" + '|'.join(self.escaped_string(self.canonical(o)) for o in origins)
+        url += "&destinations=" + '|'.join(self.escaped_string(self.canonical(d)) for d in destinations)
+        url += "&departure_time=" + self.datetime_to_unix(departure_time)
+        url += "&traffic_model=" + traffic_model
+        url += "&key=" + self.KEY
+        return url
+
+    def get_estimated_times(self, origins, destinations, departure_time, traffic_model='best_guess'):
+        """
+        travel times (in minutes) from every origin to every destination,
+        leaving at departure_time.  returns {(origin, destination): minutes}, 
+        leaving out any pairs the API couldn't find a route for.  every 
+        result is also recorded in self.samples
+        """
+        ndest = min(self.max_destinations, len(destinations))
+        norig = min(self.max_origins, max(1, self.max_elements // ndest))
+
+        result = {}
+        for ii in range(0, len(origins), norig):
+            origin_chunk = origins[ii:ii+norig]
+            for jj in range(0, len(destinations), ndest):
+                destination_chunk = destinations[jj:jj+ndest]
+                url = self.build_matrix_url(origin_chunk, destination_chunk, 
+                    departure_time, traffic_model=traffic_model)
+                data = self.get_response(url, elements=len(origin_chunk)*len(destination_chunk))
+                if data.get('status', 'OK') != 'OK':
+                    raise ValueError(f"Distance matrix request failed ({data.get('status')}) with url:\n{self.request_key(url)}")
+
+                for origin, row in zip(origin_chunk, data['rows']):
+                    for destination, element in zip(destination_chunk, row['elements']):
+                        if element.get('status') != 'OK' or 'duration_in_traffic' not in element:
+                            continue
+                        travel_time = element['duration_in_traffic']['value']/60
+                        result[(origin, destination)] = travel_time
+                        self.add_sample((origin, destination, traffic_model), departure_time, travel_time)
+        return result
+
+    def prefetch_commutes(self, addresses, commutes, year, month, first_day, ndays, timezone, 
+        models, guess=45, columns=None):
+        """
+        batch the commutes home and the first guess at each commute to work 
+        for every address in addresses (only for the commutes in columns, 
+        if given), skipping anything already sampled.  commutes that share
+        a departure (or arrival) time go in the same request.  failures are
+        left for get_commute_times to retry one by one.
+        """
+        from collections import defaultdict
+
+        addresses = [self.canonical(address) for address in addresses]
+        commutes = self.canonical_commutes(commutes)
+
+        ## {(direction, departure_time, model): set of (origin, destination)}
+        needed = defaultdict(set)
+        for name, info in commutes.items():
+            for day in range(first_day, first_day + ndays):
+                arrival = timezone.localize(datetime(year, month, day, 
+                    hour=info['arrival_hour'], minute=info['arrival_minute']))
+                departure = timezone.localize(datetime(year, month, day, 
+                    hour=info['departure_hour'], minute=info['departure_minute']))
+                for model in models:
+                    for address in addresses:
+                        if columns is None or f'{name}_towork' in columns:
+                            needed[('towork', arrival - timedelta(minutes=guess), model)].add((address, info['address']))
+                        if columns is None or f'{name}_tohome' in columns:
+                            needed[('tohome', departure, model)].add((info['address'], address))
+
+        for (direction, departure_time, model), pairs in needed.items():
+            pairs = [(o, d) for o, d in pairs 
+                if self.lookup_sample((o, d, model), departure_time) is None]
+            if not len(pairs):
+                continue
+            origins = sorted(set(o for o, _ in pairs))
+            destinations = sorted(set(d for _, d in pairs))
+            try:
+                self.get_estimated_times(origins, destinations, departure_time, traffic_model=model)
+            except ValueError as e:
+                print(f"Skipping batch of {len(pairs)} {direction} commutes: {str(e).splitlines()[0]}")
+
+
 def main():
     from argparse import ArgumentParser
     from load_config import load_config
+    from response_cache import add_cache_arguments, cache_from_args
+    from transports import add_transport_arguments, transport_from_args
+    from metrics import Profiler, add_metrics_arguments
+    from geocode import add_geocode_arguments, geocode_cache_from_args
 
     parser = ArgumentParser()
     parser.add_argument("address", help="Address to calculate commutes to/from")
@@ -217,9 +899,27 @@ def main():
     parser.add_argument('--first_day', default=6, help="Start on Aug 6 2019, a Tuesday", type=int)
     parser.add_argument('--ndays', default=4, help="How many days to run for (i.e. work week)", type=int)
     parser.add_argument('--return_model', default='best_guess', help="Model to print over-arching summary for")
+    parser.add_argument('--backend', default='directions', choices=['directions', 'matrix'],
+        help="Query the Directions API one route at a time, or batch requests through the Distance Matrix API")
+    parser.add_argument('--api_root', default="https://maps.googleapis.com/maps/api/",
+        help="Root url of the maps API (e.g. to point at stub_server.py)")
+    add_cache_arguments(parser)
+    add_transport_arguments(parser)
+    add_geocode_arguments(parser)
+    parser.add_argument('--profiles', action='store_true',
+        help="Also print each commute as a function of departure time around the usual times")
+    parser.add_argument('--profile_before', default=120, type=int, help="Minutes before the usual time to start profiles at")
+    parser.add_argument('--profile_after', default=60, type=int, help="Minutes after the usual time to end profiles at")
+    parser.add_argument('--profile_step', default=15, type=int, help="Minutes between departure times in profiles")
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
 
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler(args.profile)
+        profiler.start()
+
     config, timezone = load_config(args.config_filename)
     commutes = config['commutes']
     api_key = config['api_key']
@@ -239,7 +939,10 @@ def main():
     #     import tzlocal
     #     timezone = tzlocal.get_localzone()
 
-    CommuteTimes = CommuteTimesClass(key=api_key)
+    backend = DistanceMatrixClass if args.backend == 'matrix' else CommuteTimesClass
+    CommuteTimes = backend(key=api_key, cache=cache_from_args(args), offline=args.offline,
+        api_root=args.api_root, transport=transport_from_args(args),
+        geocode=args.geocode, geocode_cache=geocode_cache_from_args(args), precision=args.precision)
     res = CommuteTimes.get_commute_times(args.address, commutes, 
         args.year, args.month, args.first_day, args.ndays, 
         timezone, return_model=args.return_model)
@@ -254,5 +957,29 @@ def main():
         th = str(int(round(res[name+'_tohome']))).center(15)
         print(name.ljust(10)+'|' + tw + '|' + th)
 
+    if args.profiles:
+        ## reuses everything sampled above, so only fills in the gaps
+        requests_before = CommuteTimes.metrics.counters['requests']
+        profiles = CommuteTimes.get_commute_profiles(args.address, commutes, 
+            args.year, args.month, args.first_day, args.ndays, timezone, 
+            traffic_model=args.return_model, before=args.profile_before, 
+            after=args.profile_after, step=args.profile_step)
+        CommuteTimes.print_profiles(profiles, timezone, step=args.profile_step)
+        print()
+        print(f"Made {CommuteTimes.metrics.counters['requests'] - requests_before} more API requests for the profiles")
+
+    if CommuteTimes.cache is not None:
+        print()
+        print(CommuteTimes.cache.summary())
+    if CommuteTimes.geocode_cache is not None:
+        print(CommuteTimes.geocode_cache.summary())
+
+    print()
+    print(CommuteTimes.metrics.report())
+    if args.metrics is not None:
+        CommuteTimes.metrics.write(args.metrics, extra=dict(address=args.address, backend=args.backend))
+    if profiler is not None:
+        profiler.stop()
+
 if __name__ == "__main__":
     main()
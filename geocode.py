@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""
+addresses as the API sees them:  free-text addresses are normalized (so
+"123 Main Street" and "123  main st." are the same place) and resolved
+once, with the Geocoding API, to coordinates that are stored in an
+on-disk cache.  CommuteTimesClass then queries with coordinates, which
+keeps its request cache keys stable across spellings and runs.
+coordinates can also be snapped to a fixed number of decimal places, so
+nearby points (e.g. grid cells from slightly different grids) share
+requests.
+
+stub_server.py (and --transport synthetic) answer geocoding requests
+too, so all of this works without an API key.
+"""
+
+import os
+import re
+import time
+import sqlite3
+import threading
+
+DEFAULT_GEOCODE_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'commute_times', 'geocode.sqlite')
+
+## common spellings -> the abbreviation we use in normalized addresses
+ABBREVIATIONS = {
+    'street': 'st', 'avenue': 'ave', 'av': 'ave', 'boulevard': 'blvd', 'road': 'rd',
+    'drive': 'dr', 'lane': 'ln', 'court': 'ct', 'place': 'pl', 'terrace': 'ter',
+    'highway': 'hwy', 'parkway': 'pkwy', 'circle': 'cir', 'square': 'sq',
+    'suite': 'ste', 'apartment': 'apt', 'north': 'n', 'south': 's', 'east': 'e',
+    'west': 'w', 'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw',
+}
+COUNTRY_SUFFIXES = ['usa', 'us', 'united states', 'united states of america']
+
+
+def parse_latlng(address):
+    """
+    (lat, lng) if address is already a "lat,lng" pair, otherwise None
+    """
+    try:
+        lat, lng = [float(v) for v in address.split(',')]
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+def format_latlng(lat, lng, precision=None):
+    """
+    "lat,lng", rounded to precision decimal places if given (5 places is
+    about a meter; 3 is about 100m)
+    """
+    if precision is None:
+        return f'{lat},{lng}'
+    return f'{lat:.{precision}f},{lng:.{precision}f}'
+
+def normalize_address(address):
+    """
+    a canonical spelling of a free-text address, for use as a cache key:
+    lowercase, no punctuation besides commas, single spaces, standard
+    abbreviations, and without a trailing country
+    """
+    address = re.sub(r"[^\w\s,#-]", ' ', address.lower())
+    parts = []
+    for part in address.split(','):
+        words = [ABBREVIATIONS.get(word, word) for word in part.split()]
+        if len(words):
+            parts.append(' '.join(words))
+    while len(parts) > 1 and parts[-1] in COUNTRY_SUFFIXES:
+        parts.pop()
+    return ', '.join(parts)
+
+
+class GeocodeCache:
+    """
+    on-disk (sqlite) map from normalized addresses to coordinates, like
+    response_cache.ResponseCache.  places don't move, so entries never
+    expire
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        ## shared between worker threads, so serialize access ourselves
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS places ("
+            "address TEXT PRIMARY KEY, lat REAL, lng REAL, formatted_address TEXT, created REAL)")
+        self.db.commit()
+
+    def get(self, address):
+        """
+        (lat, lng) for the normalized address, or None
+        """
+        with self.lock:
+            row = self.db.execute("SELECT lat, lng FROM places WHERE address = ?", (address,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row
+
+    def put(self, address, lat, lng, formatted_address=None):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?, ?)",
+                (address, lat, lng, formatted_address, time.time()))
+            self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM places").fetchone()[0]
+
+    def summary(self):
+        return f"Geocode cache: {self.hits} hits, {self.misses} misses, {len(self)} places in {self.filename}"
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def add_geocode_arguments(parser):
+    parser.add_argument('--geocode', action='store_true',
+        help="Resolve addresses to coordinates (once, with the Geocoding API) and query with those")
+    parser.add_argument('--geocode_cache', default=DEFAULT_GEOCODE_CACHE,
+        help="sqlite file to store geocoded addresses in")
+    parser.add_argument('--precision', default=None, type=int,
+        help="Round coordinates to this many decimal places before querying, so nearby points share requests")
+
+def geocode_cache_from_args(args):
+    if not args.geocode:
+        return None
+    return GeocodeCache(args.geocode_cache)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import threading
+
+import numpy as np
+
+
+class GridCheckpoint:
+    """
+    append-only (jsonl) log of grid cells as they finish, so a grid build
+    that dies partway through can pick up where it left off.
+
+    the first line holds the grid parameters (bounds, npts, etc), which
+    must match when resuming; every other line is one cell:
+
+        {"cell": <index into the grid>, "lat": ..., "long": ...,
+         "result": {<key>: minutes} or null, "error": <message> or null}
+    """
+    def __init__(self, filename, meta, resume=False):
+        self.filename = filename
+        self.meta = meta
+        self.lock = threading.Lock()
+        self.cells = {}
+
+        if resume and os.path.exists(filename):
+            self.cells = self.load()
+        elif os.path.exists(filename) and os.path.getsize(filename):
+            raise ValueError(f"Checkpoint {filename} already exists; resume from it or remove it")
+        else:
+            with open(filename, 'w') as f:
+                f.write(json.dumps({'meta': meta}) + '\n')
+
+        self.out = open(filename, 'a')
+
+    def load(self):
+        return load_checkpoint(self.filename, self.meta)
+
+    def append(self, cell, lat, lng, result=None, error=None):
+        record = {'cell': int(cell), 'lat': float(lat), 'long': float(lng),
+            'result': result, 'error': error}
+        with self.lock:
+            self.out.write(json.dumps(record) + '\n')
+            self.out.flush()
+            os.fsync(self.out.fileno())
+            self.cells[record['cell']] = record
+
+    def __contains__(self, cell):
+        return int(cell) in self.cells
+
+    def close(self):
+        self.out.close()
+
+def load_checkpoint(filename, meta):
+    """
+    {cell: record} for every cell in the checkpoint at filename, without
+    opening it for writing (e.g. for --dry_run).  raises a ValueError if
+    it was written for a grid other than meta
+    """
+    cells = {}
+    with open(filename, 'r') as f:
+        header = json.loads(f.readline())
+        if header.get('meta') != meta:
+            raise ValueError(f"Checkpoint {filename} was written for a different grid:\n" +
+                f"    {header.get('meta')}\nvs\n    {meta}")
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                ## a partially written last line from a crash
+                continue
+            cells[record['cell']] = record
+    return cells
+
+
+## columns every grid file has, ahead of the per-commute columns
+BASE_COLUMNS = [('cell', '<i8'), ('lat', '<f8'), ('long', '<f8'),
+    ('dlat', '<f8'), ('dlong', '<f8'), ('failed', '?')]
+GRID_FORMAT_VERSION = 1
+
+class GridFile:
+    """
+    columnar on-disk grid output:  a directory holding meta.json (grid
+    metadata and the schema) and cells.bin, a flat array of fixed-size
+    records (a numpy structured array) that's memory-mapped on read and
+    appended to on write.
+
+    each record is one cell:  its id, center lat/long, half-widths
+    (dlat/dlong), whether it failed, and one float32 column of minutes per
+    commute (e.g. alice_towork).  failed cells have NaN commutes.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.dtype = np.dtype([tuple(column) for column in self.meta['schema']])
+        self._cells = None
+
+    @classmethod
+    def create(cls, path, columns, meta=None):
+        """
+        create an empty grid file with a float32 column for each of columns
+        (e.g. ['alice_towork', 'alice_tohome']).  meta is anything else 
+        worth recording (bounds, npts, dates, models, ...)
+        """
+        os.makedirs(path, exist_ok=True)
+        meta = dict(meta or {})
+        meta.update(version=GRID_FORMAT_VERSION, columns=list(columns),
+            schema=BASE_COLUMNS + [(column, '<f4') for column in columns])
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        open(os.path.join(path, 'cells.bin'), 'wb').close()
+        return cls(path)
+
+    @property
+    def columns(self):
+        return self.meta['columns']
+
+    @property
+    def cells(self):
+        """
+        the records as a read-only memory-mapped structured array
+        """
+        if self._cells is None:
+            filename = os.path.join(self.path, 'cells.bin')
+            if os.path.getsize(filename) < self.dtype.itemsize:
+                self._cells = np.zeros(0, dtype=self.dtype)
+            else:
+                self._cells = np.memmap(filename, dtype=self.dtype, mode='r')
+        return self._cells
+
+    def __len__(self):
+        return os.path.getsize(os.path.join(self.path, 'cells.bin')) // self.dtype.itemsize
+
+    def append(self, records):
+        """
+        append records, either a structured array with our dtype or a list
+        of dicts (missing columns are filled with NaN, or False for failed)
+        """
+        if not isinstance(records, np.ndarray):
+            rows = np.zeros(len(records), dtype=self.dtype)
+            for column in self.columns:
+                rows[column] = np.nan
+            for ii, record in enumerate(records):
+                for key, value in record.items():
+                    rows[key][ii] = value
+            records = rows
+        with open(os.path.join(self.path, 'cells.bin'), 'ab') as f:
+            f.write(records.astype(self.dtype).tobytes())
+        self._cells = None
+
+    def to_dict(self, include_failed=False):
+        """
+        the grid as a dict of arrays (lat, long, dlat, dlong and a column
+        per commute), like the old pickled output
+        """
+        cells = self.cells
+        if not include_failed:
+            cells = cells[~cells['failed']]
+        data = {key: np.asarray(cells[key]) for key in ['lat', 'long', 'dlat', 'dlong']}
+        for column in self.columns:
+            data[column] = np.asarray(cells[column], dtype=float)
+        return data
+
+
+def is_pickle(filename):
+    ## grid files are directories, old outputs are single pickle files
+    return os.path.isfile(filename)
+
+def grid_from_dict(data):
+    """
+    records for a GridFile from a dict of lists (e.g. an old pickled grid),
+    working out the half-widths of uniform grids the same way plotting did
+    """
+    lats = np.asarray(data['lat'], dtype=float)
+    longs = np.asarray(data['long'], dtype=float)
+    columns = [k for k in data if k not in ['lat', 'long', 'dlat', 'dlong']]
+    if 'dlat' in data:
+        dlat, dlong = np.asarray(data['dlat']), np.asarray(data['dlong'])
+    else:
+        dlong = np.full(longs.size, np.max(longs[1:] - longs[:-1])/2 if longs.size > 1 else 0)
+        dlat = np.full(lats.size, np.max(lats[1:] - lats[:-1])/2 if lats.size > 1 else 0)
+
+    records = np.zeros(lats.size, dtype=BASE_COLUMNS + [(column, '<f4') for column in columns])
+    records['cell'] = np.arange(lats.size)
+    records['lat'], records['long'] = lats, longs
+    records['dlat'], records['dlong'] = dlat, dlong
+    for column in columns:
+        records[column] = data[column]
+    return columns, records
+
+def convert_pickle(pickle_filename, path, meta=None):
+    """
+    migrate an old pickled grid (a dict of lists) to a GridFile at path
+    """
+    import pickle
+    with open(pickle_filename, 'rb') as f:
+        data = pickle.load(f)
+    columns, records = grid_from_dict(data)
+    grid = GridFile.create(path, columns, meta=dict(meta or {}, converted_from=pickle_filename))
+    grid.append(records)
+    return grid
+
+def load_grid_data(filename):
+    """
+    load the results of build_commute_grid.py as a dict of arrays, from
+    either a GridFile directory or an old pickle
+    """
+    if is_pickle(filename):
+        import pickle
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        return {key: np.asarray(value) for key, value in data.items()}
+    return GridFile(filename).to_dict()
+
+## meta that's specific to one shard of a grid, and so is left out 
+## when checking that shards belong together
+SHARD_META = ['tile', 'shards', 'partial']
+
+def merge_grids(paths, output):
+    """
+    combine shards of a grid (GridFiles written by build_commute_grid.py 
+    --shards, or anything else with matching columns and grid parameters)
+    into one GridFile at output.  cells are identified by their id, so a
+    cell in more than one shard (e.g. from a rerun) is only kept once, 
+    from the last shard it's in
+    """
+    grids = [GridFile(path) for path in paths]
+    if not len(grids):
+        raise ValueError("No grids to merge")
+
+    def grid_meta(grid):
+        return {k: v for k, v in grid.meta.items() if k not in SHARD_META}
+    for path, grid in zip(paths[1:], grids[1:]):
+        if grid_meta(grid) != grid_meta(grids[0]):
+            raise ValueError(f"{path} doesn't belong to the same grid as {paths[0]}:\n" + 
+                f"    {grid_meta(grid)}\nvs\n    {grid_meta(grids[0])}")
+
+    records = np.concatenate([np.asarray(grid.cells) for grid in grids])
+    ## keep the last copy of each cell, in cell order
+    _, last = np.unique(records['cell'][::-1], return_index=True)
+    records = records[::-1][last]
+
+    meta = {k: v for k, v in grid_meta(grids[0]).items() if k not in ['version', 'columns', 'schema']}
+    meta.update(merged_from=list(paths), partial=any(grid.meta.get('partial', False) for grid in grids))
+    merged = GridFile.create(output, grids[0].columns, meta=meta)
+    merged.append(records)
+    return merged
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert an old pickled grid to the columnar grid format")
+    parser.add_argument('pickle_dump')
+    parser.add_argument('output', help="Directory to write the grid to")
+
+    args = parser.parse_args()
+
+    grid = convert_pickle(args.pickle_dump, args.output)
+    print(f"Wrote {len(grid)} cells with columns {', '.join(grid.columns)} to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+estimate commute times between the points sampled by build_commute_grid.py,
+so a sparse (or adaptive) grid can still be drawn as a smooth, dense map.
+
+two methods are available:
+    idw:     inverse-distance weighting, optionally over only the k nearest
+             samples (found with scipy's cKDTree if it's installed)
+    linear:  linear interpolation over a Delaunay triangulation of the
+             samples (requires scipy); falls back to idw outside the hull
+
+distances are computed in a local flat projection (longitude scaled by
+cos(latitude)), which is plenty accurate at the scale of a city.
+"""
+
+import numpy as np
+
+
+def project(lats, longs, lat0):
+    """
+    local equirectangular projection, in degrees of latitude
+    """
+    return np.column_stack([np.asarray(longs)*np.cos(np.radians(lat0)), np.asarray(lats)])
+
+def nearest_distances(points, queries, k=1):
+    """
+    distances from each query to its k nearest points (and their indices),
+    using a KD-tree if scipy is available and brute force otherwise
+    """
+    k = min(k, len(points))
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        cKDTree = None
+
+    if cKDTree is not None:
+        dist, idx = cKDTree(points).query(queries, k=k)
+        return dist.reshape(len(queries), k), idx.reshape(len(queries), k)
+
+    dist = np.empty((len(queries), k))
+    idx = np.empty((len(queries), k), dtype=int)
+    ## in chunks, so we never build more than chunk x len(points) at once
+    chunk = max(1, 2**22 // max(1, len(points)))
+    for start in range(0, len(queries), chunk):
+        d = np.linalg.norm(queries[start:start+chunk, None, :] - points[None, :, :], axis=-1)
+        part = np.argpartition(d, k-1, axis=1)[:, :k]
+        pd = np.take_along_axis(d, part, axis=1)
+        order = np.argsort(pd, axis=1)
+        idx[start:start+chunk] = np.take_along_axis(part, order, axis=1)
+        dist[start:start+chunk] = np.take_along_axis(pd, order, axis=1)
+    return dist, idx
+
+def idw(points, values, queries, power=2, k=None):
+    """
+    inverse-distance weighted estimate of values (npoints x nkeys) at each
+    of queries.  uses all of the points unless k is given
+    """
+    values = np.asarray(values, dtype=float)
+    if k is not None:
+        dist, idx = nearest_distances(points, queries, k=k)
+        weights = 1/np.maximum(dist, 1e-12)**power
+        estimate = np.einsum('qk,qkv->qv', weights, values[idx])/weights.sum(axis=1)[:, None]
+        return estimate
+
+    estimate = np.empty((len(queries), values.shape[1]))
+    chunk = max(1, 2**22 // max(1, len(points)))
+    for start in range(0, len(queries), chunk):
+        dist = np.linalg.norm(queries[start:start+chunk, None, :] - points[None, :, :], axis=-1)
+        weights = 1/np.maximum(dist, 1e-12)**power
+        estimate[start:start+chunk] = weights @ values / weights.sum(axis=1)[:, None]
+    return estimate
+
+def linear(points, values, queries, **kwargs):
+    """
+    linear interpolation on the Delaunay triangulation of points; anything
+    outside the convex hull is filled in with idw
+    """
+    from scipy.interpolate import LinearNDInterpolator
+
+    values = np.asarray(values, dtype=float)
+    estimate = LinearNDInterpolator(points, values)(queries)
+    outside = np.isnan(estimate).any(axis=1)
+    if outside.any():
+        estimate[outside] = idw(points, values, queries[outside], **kwargs)
+    return estimate
+
+METHODS = {'idw': idw, 'linear': linear}
+
+def sample_arrays(data):
+    """
+    split a build_commute_grid.py result into lats, longs, the names of
+    the commute columns, and a (npoints x ncolumns) array of values
+    """
+    keys = [k for k in data if k not in ['lat', 'long', 'dlat', 'dlong']]
+    values = np.column_stack([np.asarray(data[k], dtype=float) for k in keys])
+    return np.asarray(data['lat'], dtype=float), np.asarray(data['long'], dtype=float), keys, values
+
+def finite_groups(values):
+    """
+    group the columns of values by which samples are finite (e.g. a 
+    partially updated grid has NaNs in the columns being updated), so each
+    group can be interpolated from just its own samples.  returns a list
+    of (mask of samples, list of column indices)
+    """
+    finite = np.isfinite(values)
+    groups = {}
+    for ii in range(values.shape[1]):
+        groups.setdefault(finite[:, ii].tobytes(), []).append(ii)
+    return [(finite[:, columns[0]], columns) for columns in groups.values()]
+
+def interpolate_grid(data, npts, method='idw', max_distance=None, **kwargs):
+    """
+    interpolate the samples in data (a build_commute_grid.py result) onto a
+    regular npts x npts raster spanning the same area, and return it in the
+    same format (including the dlat/dlong half-widths of each cell).
+
+    raster cells further than max_distance (in degrees of latitude) from any
+    sample are left out, so we don't extrapolate out over the water; it
+    defaults to twice the typical spacing between samples
+    """
+    lats, longs, keys, values = sample_arrays(data)
+    lat0 = lats.mean()
+    points = project(lats, longs, lat0)
+
+    yv = np.linspace(lats.min(), lats.max(), npts)
+    xv = np.linspace(longs.min(), longs.max(), npts)
+    grid_longs, grid_lats = [a.ravel() for a in np.meshgrid(xv, yv, indexing='ij')]
+    queries = project(grid_lats, grid_longs, lat0)
+
+    if max_distance is None:
+        spacing, _ = nearest_distances(points, points, k=2)
+        max_distance = 2*np.median(spacing[:, 1])
+    nearest, _ = nearest_distances(points, queries, k=1)
+    keep = nearest[:, 0] <= max_distance
+
+    estimate = np.full((keep.sum(), len(keys)), np.nan)
+    for samples, columns in finite_groups(values):
+        if samples.any():
+            estimate[:, columns] = METHODS[method](points[samples], values[samples][:, columns], 
+                queries[keep], **kwargs)
+
+    dense = {'lat': grid_lats[keep], 'long': grid_longs[keep],
+        'dlat': np.full(keep.sum(), (yv[1] - yv[0])/2),
+        'dlong': np.full(keep.sum(), (xv[1] - xv[0])/2)}
+    for ii, key in enumerate(keys):
+        dense[key] = estimate[:, ii]
+    return dense
+
+def leave_one_out_estimate(points, values, method='idw', **kwargs):
+    """
+    estimate of each sample's values from all of the other samples
+    """
+    if method == 'idw' and kwargs.get('k') is None:
+        ## a chunk of rows at a time:  drop each point's own weight from its row
+        estimate = np.empty_like(values)
+        chunk = max(1, 2**22 // max(1, len(points)))
+        for start in range(0, len(points), chunk):
+            rows = np.arange(start, min(start + chunk, len(points)))
+            dist = np.linalg.norm(points[rows, None, :] - points[None, :, :], axis=-1)
+            dist[rows - start, rows] = np.inf
+            weights = 1/np.maximum(dist, 1e-12)**kwargs.get('power', 2)
+            estimate[rows] = weights @ values / weights.sum(axis=1)[:, None]
+    else:
+        estimate = np.empty_like(values)
+        everything = np.ones(len(points), dtype=bool)
+        for ii in range(len(points)):
+            everything[ii] = False
+            estimate[ii] = METHODS[method](points[everything], values[everything], points[ii:ii+1], **kwargs)[0]
+            everything[ii] = True
+    return estimate
+
+def leave_one_out(data, method='idw', **kwargs):
+    """
+    leave-one-out error of the interpolation:  predict each sample from all
+    of the others.  samples that are missing (NaN) in a column are left out
+    of that column.  returns {key: (mean abs error, rms error, max abs error)}
+    """
+    lats, longs, keys, values = sample_arrays(data)
+    points = project(lats, longs, lats.mean())
+
+    estimate = np.full_like(values, np.nan)
+    for samples, columns in finite_groups(values):
+        if samples.sum() > 1:
+            estimate[np.ix_(samples, columns)] = leave_one_out_estimate(points[samples], 
+                values[samples][:, columns], method=method, **kwargs)
+
+    report = {}
+    for ii, key in enumerate(keys):
+        error = estimate[:, ii] - values[:, ii]
+        error = error[np.isfinite(error)]
+        if not len(error):
+            report[key] = (np.nan, np.nan, np.nan)
+            continue
+        report[key] = (np.mean(np.abs(error)), np.sqrt(np.mean(error**2)), np.max(np.abs(error)))
+    return report
+
+def print_error_report(report):
+    print("Leave-one-out error (minutes):")
+    print("commute".ljust(25) + "mean abs".rjust(10) + "rms".rjust(10) + "max".rjust(10))
+    for key, (mae, rms, worst) in report.items():
+        print(key.ljust(25) + f"{mae:10.1f}{rms:10.1f}{worst:10.1f}")
+
+def main():
+    import pickle
+    import argparse
+    from grid_io import load_grid_data, grid_from_dict, GridFile
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('grid', help="Output of build_commute_grid.py (a grid directory or an old pickle)")
+    parser.add_argument('--output', default=None, help="Directory (or .pkl file) to write the interpolated grid to")
+    parser.add_argument('--npts', default=100, type=int, help="Number of points on each side of the interpolated grid")
+    parser.add_argument('--method', default='idw', choices=list(METHODS))
+    parser.add_argument('--power', default=2, type=float, help="Power of the distance weighting for idw")
+    parser.add_argument('--k', default=None, type=int, help="Only weight the k nearest samples for idw")
+
+    args = parser.parse_args()
+
+    data = load_grid_data(args.grid)
+
+    kwargs = dict(power=args.power, k=args.k)
+    print_error_report(leave_one_out(data, method=args.method, **kwargs))
+
+    if args.output is not None:
+        dense = interpolate_grid(data, args.npts, method=args.method, **kwargs)
+        print(f"Writing {len(dense['lat'])} interpolated points to {args.output}...")
+        if args.output.rsplit('.', 1)[-1] in ['pkl', 'pickle']:
+            with open(args.output, 'wb') as out:
+                pickle.dump(dense, out)
+        else:
+            columns, records = grid_from_dict(dense)
+            GridFile.create(args.output, columns, meta=dict(interpolated_from=args.grid, 
+                method=args.method, npts=args.npts)).append(records)
+
+if __name__ == "__main__":
+    main()
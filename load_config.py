@@ -8,6 +8,8 @@ def validate_config(config):
         raise KeyError("Must supply a list of commutes in the config file")
     if 'api_key' not in config or not len(config['api_key']):
         raise KeyError("Must supply a Google API Key (w/ Directions and JavaScript Maps activated)")
+    if 'api_keys' in config and (not isinstance(config['api_keys'], list) or not len(config['api_keys'])):
+        raise KeyError("api_keys must be a list of Google API keys (e.g. one per grid shard)")
 
 def load_config(config_filename=None):
     if config_filename is None:
@@ -16,7 +18,7 @@ def load_config(config_filename=None):
         config_filename = basedir+'/private_info.txt'
 
     with open(config_filename, 'r') as f:
-        config = yaml.load(f)
+        config = yaml.safe_load(f)
 
     if 'timezone' in config and len(config['timezone']):
         timezone = pytz.timezone(config.pop('timezone'))
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+"""
+merge the shards of a grid built with build_commute_grid.py --shards (which
+does this itself once every shard is done) into one grid for
+plot_commute_grid.py, e.g. after rerunning some of the shards by hand
+"""
+
+from grid_io import merge_grids
+
+def main():
+    import glob
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', help="Directory to write the merged grid to")
+    parser.add_argument('shards', nargs='*', 
+        help="Shard grids to merge (defaults to everything in <output>.shards/)")
+
+    args = parser.parse_args()
+
+    shards = args.shards or sorted(glob.glob(args.output + '.shards/tile_*[0-9]'))
+    grid = merge_grids(shards, args.output)
+    print(f"Merged {len(shards)} shards into {len(grid)} cells in {args.output}" + 
+          (" (some shards are only partially done)" if grid.meta['partial'] else ""))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""
+run metrics for CommuteTimesClass and the grid builder:  counters (API
+requests, retries, cache hits, failures by status, ...) and histograms
+(request latency, API requests per departure time solve, per grid cell,
+...), so we can tell where the time and the money go.
+
+metrics are thread-safe and cheap enough to always be on; write them out
+with Metrics.write (json or csv, depending on the extension).  Profiler
+is an optional cProfile hook that also covers worker threads.
+"""
+
+import sys
+import csv
+import json
+import bisect
+import threading
+from collections import Counter
+
+
+class Histogram:
+    """
+    fixed-bucket histogram:  count, sum, min and max, plus counts in
+    buckets with the given (sorted) upper bounds and an overflow bucket.
+    percentiles are estimated as the upper bound of their bucket
+    """
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        target = q/100*self.count
+        seen = 0
+        for bound, count in zip(self.bounds + [self.max], self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        buckets = {f'<={bound:g}': count for bound, count in zip(self.bounds, self.counts)}
+        buckets[f'>{self.bounds[-1]:g}'] = self.counts[-1]
+        return dict(count=self.count, sum=self.total,
+            mean=self.total/self.count if self.count else None,
+            min=self.min, max=self.max, p50=self.percentile(50),
+            p90=self.percentile(90), p99=self.percentile(99), buckets=buckets)
+
+
+## bucket upper bounds for the histograms we know about; anything else
+## gets powers of two
+LATENCY_BOUNDS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+COUNT_BOUNDS = [0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50, 100]
+BOUNDS = {
+    'request_seconds': LATENCY_BOUNDS,
+    'cell_seconds': [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300],
+    'solve_requests': COUNT_BOUNDS,
+    'solve_iterations': COUNT_BOUNDS,
+    'cell_requests': COUNT_BOUNDS,
+}
+
+class Metrics:
+    """
+    thread-safe named counters and histograms, e.g.
+
+        metrics.count('retries')
+        metrics.count('failures.OVER_QUERY_LIMIT')
+        metrics.observe('request_seconds', 0.21)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(BOUNDS.get(name, [2**ii for ii in range(16)]))
+            self.histograms[name].observe(value)
+
+    def summary(self):
+        with self.lock:
+            return dict(counters=dict(sorted(self.counters.items())),
+                histograms={name: h.summary() for name, h in sorted(self.histograms.items())})
+
+    def rows(self):
+        """
+        the summary flattened into (metric, statistic, value) rows
+        """
+        summary = self.summary()
+        rows = [(name, 'count', value) for name, value in summary['counters'].items()]
+        for name, stats in summary['histograms'].items():
+            for stat, value in stats.items():
+                if stat == 'buckets':
+                    rows += [(name, bucket, count) for bucket, count in value.items()]
+                else:
+                    rows.append((name, stat, value))
+        return rows
+
+    def write(self, filename, extra=None):
+        """
+        write the summary to filename, as csv if it ends in .csv and json
+        otherwise.  extra is anything else worth recording (e.g. run
+        parameters and totals), which goes at the top level of the json
+        or in rows of its own in the csv
+        """
+        if filename.endswith('.csv'):
+            with open(filename, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['metric', 'statistic', 'value'])
+                writer.writerows([(key, 'value', value) for key, value in (extra or {}).items()])
+                writer.writerows(self.rows())
+        else:
+            with open(filename, 'w') as f:
+                json.dump(dict(extra or {}, **self.summary()), f, indent=2)
+
+    def report(self):
+        """
+        a short human readable summary of the main metrics
+        """
+        summary = self.summary()
+        counters = Counter(summary['counters'])
+        lines = [f"{counters['requests']} API requests ({counters['retries']} retries), " +
+                 f"{counters['cache_hits']} cache hits, {counters['sample_hits']} repeated samples"]
+        failures = {k.split('.', 1)[1]: v for k, v in counters.items() if k.startswith('failures.')}
+        if len(failures):
+            lines.append("Failures: " + ', '.join(f'{k}: {v}' for k, v in sorted(failures.items())))
+        for name, label in [('request_seconds', 'Request latency (s)'),
+                ('solve_requests', 'API requests per solve'), ('cell_requests', 'API requests per cell')]:
+            if name in summary['histograms']:
+                h = summary['histograms'][name]
+                lines.append(f"{label}: mean {h['mean']:.3g}, p50 {h['p50']:.3g}, " +
+                             f"p90 {h['p90']:.3g}, p99 {h['p99']:.3g}, max {h['max']:.3g}")
+        if counters['solves_unconverged']:
+            lines.append(f"{counters['solves_unconverged']} departure time solves didn't converge")
+        return '\n'.join(lines)
+
+
+class Profiler:
+    """
+    cProfile hook that can cover several threads:  call start() in every
+    thread to profile (e.g. as a ThreadPoolExecutor initializer), then
+    stop() once they're done to write the combined stats to filename
+    (readable with pstats or snakeviz).
+
+    before python 3.12, a cProfile profiler only sees the thread that 
+    enabled it, so each thread gets its own.  since then, one profiler 
+    sees every thread and only one can be enabled at a time, so only the
+    first start() does anything
+    """
+    per_thread = sys.version_info < (3, 12)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.profiles = []
+
+    def start(self):
+        import cProfile
+        with self.lock:
+            if not self.per_thread and len(self.profiles):
+                return
+            profile = cProfile.Profile()
+            self.profiles.append(profile)
+        profile.enable()
+
+    def stop(self, nlines=20):
+        import pstats
+        for profile in self.profiles:
+            profile.disable()
+        stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(self.filename)
+        print(f"Wrote profile to {self.filename}; top {nlines} functions by cumulative time:")
+        stats.sort_stats('cumulative').print_stats(nlines)
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics', default=None,
+        help="File to write a summary of the run's metrics to (.csv for csv, otherwise json)")
+    parser.add_argument('--profile', default=None, help="File to write cProfile stats for the run to")
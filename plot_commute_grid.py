@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import os
-import pickle
 import numpy as np
 from itertools import product
 
@@ -15,6 +14,7 @@ from bokeh.palettes import all_palettes
 from bokeh.layouts import gridplot
 
 from load_config import load_config
+from grid_io import load_grid_data
 
 def restructure_key(key):
     name,dest = key.split('_')
@@ -54,12 +54,73 @@ def plot_patches_on_gmap(vertex_xcoords, vertex_ycoords, api_key,
 
     return plot
 
+def plot_image_on_gmap(image, x, y, dw, dh, api_key, color_mapper,
+        map_options=None, title=None, alpha=0.25, color_bar=True):
+    """
+    same idea as plot_patches_on_gmap, but draws a single raster image 
+    (e.g. from rasterize_cells), which is far lighter than one polygon
+    per cell for very large grids
+    """
+    plot = bk.gmap(api_key, map_options=map_options, title=title)
+    plot.add_tools(PanTool(), WheelZoomTool(), ResetTool())
+    plot.image(image=[image], x=x, y=y, dw=dw, dh=dh, 
+        color_mapper=color_mapper, global_alpha=alpha)
+
+    if color_bar:
+        color_bar = ColorBar(color_mapper=color_mapper, 
+            border_line_color=None, location=(0,0), scale_alpha=alpha,
+            title="minutes")
+        plot.add_layout(color_bar, 'right')
+    return plot
+
+def cell_vertices(center_longs, center_lats, dlong, dlat):
+    """
+    corners of every cell as (N, 4) arrays of longitudes and latitudes
+    """
+    xs = center_longs[:, None] + dlong[:, None]*np.array([-1, -1, 1, 1])
+    ys = center_lats[:, None] + dlat[:, None]*np.array([-1, 1, 1, -1])
+    return xs, ys
+
+def classify_cells(values, max_happy_commute):
+    """
+    values is a (cells x commutes) array; returns the number of unhappy 
+    commutes in each cell (0 = happy place, 1 = one unhappy, 2+ = ruled out).
+    missing (NaN) commutes count as unhappy, so cells we don't know about
+    (e.g. in a partially updated grid) never look like the happy place
+    """
+    return (~(values <= max_happy_commute)).sum(axis=1)
+
+def rasterize_cells(center_longs, center_lats, dlong, dlat, values):
+    """
+    paint (possibly variable-size) cells onto a regular raster at the 
+    resolution of the smallest cell.  values is (cells x layers); returns
+    a list of 2d images (NaN where there are no cells) plus the x, y, dw, dh
+    of the image's lower left corner and size
+    """
+    pixel_x, pixel_y = 2*dlong.min(), 2*dlat.min()
+    x0, y0 = (center_longs - dlong).min(), (center_lats - dlat).min()
+    nx = int(round(((center_longs + dlong).max() - x0)/pixel_x))
+    ny = int(round(((center_lats + dlat).max() - y0)/pixel_y))
+
+    ## lower left pixel and width (in pixels) of every cell
+    ix = np.round((center_longs - dlong - x0)/pixel_x).astype(int)
+    iy = np.round((center_lats - dlat - y0)/pixel_y).astype(int)
+    size = np.maximum(1, np.round(2*dlong/pixel_x)).astype(int)
+
+    images = np.full((values.shape[1], ny, nx), np.nan)
+    for s in np.unique(size):
+        these = size == s
+        for jx in range(s):
+            for jy in range(s):
+                images[:, np.minimum(iy[these] + jy, ny - 1), np.minimum(ix[these] + jx, nx - 1)] = values[these].T
+    return list(images), x0, y0, nx*pixel_x, ny*pixel_y
+
 def main():
     import argparse
     from load_config import load_config
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('pickle_dump')
+    parser.add_argument('grid', help="Output of build_commute_grid.py (a grid directory or an old pickle)")
     parser.add_argument('output_file')
     parser.add_argument('-c', '--config_filename', dest='config_filename', help="Config file with private info", default=None)
     parser.add_argument('--max_happy_commute', default=45, type=float, help="For plot that overlays all the commutes, what's the longest not colored red?")
@@ -72,36 +133,52 @@ def main():
         help="Number of colors to use.  Must be able to access bokeh.palettes.all_palettes[<palette>][<ncolors>]")
     parser.add_argument('--cbar_min', default=15, type=float)
     parser.add_argument('--cbar_max', default=75, type=float)
+    parser.add_argument('--interpolate', default=None, type=int, 
+        help="Interpolate the samples onto a grid with this many points on a side before plotting")
+    parser.add_argument('--interp_method', default='idw', help="Interpolation method (idw or linear)")
+    parser.add_argument('--interp_k', default=None, type=int, help="Only use the k nearest samples for idw interpolation")
+    parser.add_argument('--raster', action='store_true', help="Draw the cells as an image rather than one polygon per cell")
+    parser.add_argument('--max_patches', default=20000, type=int, 
+        help="Automatically draw the cells as an image if there are more than this many")
     
     args = parser.parse_args()
     
     config, timezome = load_config(args.config_filename)
     api_key = config['api_key']
 
-    with open(args.pickle_dump, 'rb') as f:
-        print(f"Loading from {args.pickle_dump}")
-        data = pickle.load(f)
+    print(f"Loading from {args.grid}")
+    data = load_grid_data(args.grid)
+
+    if args.interpolate is not None:
+        from interpolate_grid import interpolate_grid, leave_one_out, print_error_report
+        print_error_report(leave_one_out(data, method=args.interp_method, k=args.interp_k))
+        data = interpolate_grid(data, args.interpolate, method=args.interp_method, k=args.interp_k)
 
-    center_lats = np.array(data.pop('lat'))
-    center_longs = np.array(data.pop('long'))
-    names = set(k.split('_')[0] for k in data)
+    center_lats = np.asarray(data.pop('lat'), dtype=float)
+    center_longs = np.asarray(data.pop('long'), dtype=float)
 
-    dx = np.max(center_longs[1:] - center_longs[:-1])/2
-    dy = np.max(center_lats[1:] - center_lats[:-1])/2
+    if 'dlat' in data:
+        ## cell sizes are stored with the grid (and vary for adaptive grids)
+        dx = np.asarray(data.pop('dlong'), dtype=float)
+        dy = np.asarray(data.pop('dlat'), dtype=float)
+    else:
+        dx = np.full(center_longs.size, np.max(center_longs[1:] - center_longs[:-1])/2)
+        dy = np.full(center_lats.size, np.max(center_lats[1:] - center_lats[:-1])/2)
+    names = list(dict.fromkeys(k.split('_')[0] for k in data))
 
-    xcoords = [[xc-dx, xc-dx, xc+dx, xc+dx] for xc in center_longs]
-    ycoords = [[yc-dy, yc+dy, yc+dy, yc-dy] for yc in center_lats]
-    print(f"Plotting {len(xcoords)} squares")
+    xcoords, ycoords = cell_vertices(center_longs, center_lats, dx, dy)
+    raster = args.raster or len(xcoords) > args.max_patches
+    print(f"Plotting {len(xcoords)} squares" + (" as an image" if raster else ""))
 
     try:
         args.center_lat = float(args.center_lat)
     except ValueError:
-        args.center_lat = (min([yc[0] for yc in ycoords]) + max([yc[1] for yc in ycoords]))/2
+        args.center_lat = (ycoords.min() + ycoords.max())/2
 
     try:
         args.center_lng = float(args.center_lng)
     except ValueError:
-        args.center_lng = (min([xc[0] for xc in ycoords]) + max([xc[2] for xc in ycoords]))/2        
+        args.center_lng = (xcoords.min() + xcoords.max())/2
 
     plots = []
     bk.output_file(args.output_file, title="Commute times") , #mode="inlne")
@@ -109,39 +186,43 @@ def main():
         zoom=args.zoom, map_type=args.map_type)
 
     allkeys = [f'{name}_{destkey}' for name, destkey in product(names, ['towork', 'tohome'])]
-    dsets = {restructure_key(key): data[key] for key in allkeys}
+    values = np.column_stack([np.asarray(data[key], dtype=float) for key in allkeys])
+    nunhappy = classify_cells(values, args.max_happy_commute)
 
     color_mapper = LinearColorMapper(palette=all_palettes[args.palette][args.ncolors], 
-        low=args.cbar_min, high=args.cbar_max)
-
-    nhappy = np.zeros(len(xcoords), dtype=int)
-    for name in names:
-        for destkey in ['towork', 'tohome']:
-            key = f'{name}_{destkey}'
-            colors = data[key]
-            plots.append(plot_patches_on_gmap(xcoords, ycoords, api_key, 
-                values=colors, map_options=moptions, title=restructure_key(key),
-                color_mapper=color_mapper))
+        low=args.cbar_min, high=args.cbar_max, nan_color='rgba(0, 0, 0, 0)')
 
-            msk = np.array(colors) <= args.max_happy_commute
-            nhappy[msk] += 1
-
-    ## now overlap all the commutes:
+    ## the happy place overlay:  red is ruled out (2+ unhappy commutes), orange
+    ## has exactly one unhappy commute, and the happy place is left clear
     title = f'Areas where all commutes are < {args.max_happy_commute} minutes'
-    plot = plot_patches_on_gmap(
-        list(np.array(xcoords)[nhappy<len(allkeys)-1]), 
-        list(np.array(ycoords)[nhappy<len(allkeys)-1]), 
-        api_key, map_options=moptions, title=title, solid_fill='red')
+    if raster:
+        layers = np.column_stack([values, np.minimum(nunhappy, 2)])
+        images, x0, y0, dw, dh = rasterize_cells(center_longs, center_lats, dx, dy, layers)
+        for ii, key in enumerate(allkeys):
+            plots.append(plot_image_on_gmap(images[ii], x0, y0, dw, dh, api_key, color_mapper,
+                map_options=moptions, title=restructure_key(key)))
+
+        happy_mapper = LinearColorMapper(palette=['rgba(0, 0, 0, 0)', 'orange', 'red'], 
+            low=0, high=2, nan_color='rgba(0, 0, 0, 0)')
+        plots.append(plot_image_on_gmap(images[-1], x0, y0, dw, dh, api_key, happy_mapper,
+            map_options=moptions, title=title, color_bar=False))
+    else:
+        for ii, key in enumerate(allkeys):
+            plots.append(plot_patches_on_gmap(list(xcoords), list(ycoords), api_key, 
+                values=values[:, ii], map_options=moptions, title=restructure_key(key),
+                color_mapper=color_mapper))
 
-    data = dict(
-        xs=list(np.array(xcoords)[nhappy==len(allkeys)-1]), 
-        ys=list(np.array(ycoords)[nhappy==len(allkeys)-1]))
+        ruled_out = nunhappy >= 2
+        plot = plot_patches_on_gmap(list(xcoords[ruled_out]), list(ycoords[ruled_out]), 
+            api_key, map_options=moptions, title=title, solid_fill='red')
 
-    source_patches = bk.ColumnDataSource(data=data)
-    patches_glyph = plot.patches('xs', 'ys', fill_alpha=0.25, 
-        fill_color='orange', source=source_patches, line_width=0)
+        one_unhappy = nunhappy == 1
+        source_patches = bk.ColumnDataSource(data=dict(
+            xs=list(xcoords[one_unhappy]), ys=list(ycoords[one_unhappy])))
+        patches_glyph = plot.patches('xs', 'ys', fill_alpha=0.25, 
+            fill_color='orange', source=source_patches, line_width=0)
 
-    plots.append(plot)
+        plots.append(plot)
 
 
     ## now show
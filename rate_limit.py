@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+
+
+class RateLimiter:
+    """
+    thread-safe token bucket:  allows on average `rate` requests per
+    second, with bursts of up to `burst` requests (defaults to one
+    second's worth).  call acquire() before each request; it blocks
+    until a token is available.
+    """
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens)/self.rate)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class ResponseCache:
+    """
+    on-disk (sqlite) cache of API responses, keyed on the normalized
+    request (i.e. the url without the API key), so reruns over the same
+    points only hit the network for requests we haven't seen before.
+
+    ttl is in seconds; entries older than that are treated as missing
+    and purged.  max_entries caps the size of the cache; once it's
+    exceeded, the least recently used entries are evicted.
+    """
+    def __init__(self, filename, ttl=None, max_entries=None):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        ## {key: last access time} for hits since the last write; only 
+        ## needed for eviction, and written out with the next put, so reads
+        ## never have to write to (and lock) the database
+        self.accessed = {}
+
+        ## shared between worker threads, so serialize access ourselves
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, request TEXT, response TEXT, "
+            "created REAL, accessed REAL)")
+        self.db.commit()
+        self.purge_expired()
+
+    def hash_request(self, request):
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def get(self, request):
+        key = self.hash_request(request)
+        with self.lock:
+            row = self.db.execute("SELECT response, created FROM responses WHERE key = ?",
+                (key,)).fetchone()
+
+            if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if self.max_entries is not None:
+                self.accessed[key] = time.time()
+        return json.loads(row[0])
+
+    def put(self, request, response):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (self.hash_request(request), request, json.dumps(response), now, now))
+            if self.max_entries is not None:
+                self.flush_accessed()
+                ## evict the least recently used entries beyond max_entries
+                self.db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                    "ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            self.db.commit()
+
+    def flush_accessed(self):
+        ## call with the lock held
+        self.db.executemany("UPDATE responses SET accessed = ? WHERE key = ?",
+            [(accessed, key) for key, accessed in self.accessed.items()])
+        self.accessed = {}
+
+    def purge_expired(self):
+        if self.ttl is not None:
+            with self.lock:
+                self.db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+                self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = 100*self.hits/total if total else 0
+        return f"Cache: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), {len(self)} entries in {self.filename}"
+
+    def close(self):
+        with self.lock:
+            if len(self.accessed):
+                self.flush_accessed()
+                self.db.commit()
+            self.db.close()
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache_filename', default=None,
+        help="sqlite file to cache API responses in (no caching if not given)")
+    parser.add_argument('--cache_ttl', default=None, type=float,
+        help="Age (in days) after which cached responses are ignored and evicted")
+    parser.add_argument('--cache_max_entries', default=None, type=int,
+        help="Maximum number of cached responses to keep (least recently used are evicted)")
+    parser.add_argument('--offline', action='store_true',
+        help="Only use cached responses; never query the API (requires --cache_filename)")
+
+def cache_from_args(args):
+    if args.cache_filename is None:
+        if args.offline:
+            raise ValueError("Must provide a --cache_filename to run offline")
+        return None
+    ttl = args.cache_ttl*24*3600 if args.cache_ttl is not None else None
+    return ResponseCache(args.cache_filename, ttl=ttl, max_entries=args.cache_max_entries)
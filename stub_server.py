@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""
+local stand-in for the Directions, Distance Matrix and Geocoding APIs, for testing
+without spending money.  travel times come from a simple parametric
+traffic model (see synthetic_duration), and responses follow the same
+json format as the real APIs.  point the scripts at it with e.g.
+
+    python stub_server.py --port 8765 &
+    python commute_times.py "some address" --backend matrix --api_root http://localhost:8765/
+
+or skip the server entirely with --transport synthetic (see transports.py).
+"""
+
+import math
+import json
+import time
+import hashlib
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytz
+
+MODEL_FACTORS = {'optimistic': 0.75, 'best_guess': 1.0, 'pessimistic': 1.35}
+
+
+def parse_latlng(address):
+    try:
+        lat, lng = [float(v) for v in address.split(',')]
+        return lat, lng
+    except ValueError:
+        return None
+
+def free_flow_minutes(origin, destination):
+    """
+    travel time with no traffic:  based on the distance if both ends are
+    lat,lng pairs, otherwise a (deterministic) pseudo-random 10-70 minutes
+    """
+    start, end = parse_latlng(origin), parse_latlng(destination)
+    if start is not None and end is not None:
+        dlat = math.radians(end[0] - start[0])
+        dlng = math.radians(end[1] - start[1])
+        a = math.sin(dlat/2)**2 + math.cos(math.radians(start[0]))*math.cos(math.radians(end[0]))*math.sin(dlng/2)**2
+        km = 2*6371*math.asin(math.sqrt(a))
+        ## ~40 km/h door to door, plus a few minutes to get going
+        return 5 + 1.5*km
+
+    digest = hashlib.sha256((origin + '|' + destination).encode('utf-8')).digest()
+    return 10 + 60*digest[0]/255
+
+def synthetic_location(address):
+    """
+    a (deterministic) pseudo-random point in the LA basin for a free-text
+    address
+    """
+    digest = hashlib.sha256(address.encode('utf-8')).digest()
+    lat = 33.8 + 0.4*int.from_bytes(digest[:4], 'big')/2**32
+    lng = -118.6 + 0.6*int.from_bytes(digest[4:8], 'big')/2**32
+    return round(lat, 7), round(lng, 7)
+
+def synthetic_duration(origin, destination, departure_time, traffic_model='best_guess',
+    timezone=pytz.timezone('America/Los_Angeles')):
+    """
+    minutes to get from origin to destination leaving at departure_time:  the
+    free-flow time, plus morning (8:30) and evening (17:30) rush hour bumps
+    that scale with the length of the trip, times a per-model factor
+    """
+    local = departure_time.astimezone(timezone)
+    minute = local.hour*60 + local.minute + local.second/60
+
+    free_flow = free_flow_minutes(origin, destination)
+    rush = 0.6*math.exp(-0.5*((minute - 8.5*60)/60)**2) + 0.7*math.exp(-0.5*((minute - 17.5*60)/75)**2)
+    if local.weekday() >= 5:
+        rush *= 0.3
+    return free_flow * (1 + rush) * MODEL_FACTORS.get(traffic_model, 1.0)
+
+
+def element(origin, destination, params, timezone):
+    model = params.get('traffic_model', ['best_guess'])[0]
+    if 'departure_time' in params:
+        departure_time = datetime.fromtimestamp(int(params['departure_time'][0]), tz=pytz.utc)
+    else:
+        departure_time = datetime.now(tz=pytz.utc)
+    free_flow = free_flow_minutes(origin, destination)
+    travel_time = synthetic_duration(origin, destination, departure_time, model, timezone)
+    return {
+        'duration': {'value': int(round(free_flow*60)), 'text': f'{free_flow:.0f} mins'},
+        'duration_in_traffic': {'value': int(round(travel_time*60)), 'text': f'{travel_time:.0f} mins'},
+    }
+
+def respond(path, params, timezone=pytz.timezone('America/Los_Angeles')):
+    """
+    the (HTTP status code, json response) the stub gives for a request, 
+    where params are parsed as by urllib.parse.parse_qs
+    """
+    if not params.get('key'):
+        return 200, {'status': 'REQUEST_DENIED', 'error_message': 'Missing key'}
+
+    if path.endswith('/directions/json'):
+        origin, destination = params['origin'][0], params['destination'][0]
+        leg = element(origin, destination, params, timezone)
+        leg.update(start_address=origin, end_address=destination)
+        return 200, {'status': 'OK', 'routes': [{'legs': [leg]}]}
+
+    if path.endswith('/distancematrix/json'):
+        origins = params['origins'][0].split('|')
+        destinations = params['destinations'][0].split('|')
+        if len(origins) > 25 or len(destinations) > 25 or len(origins)*len(destinations) > 100:
+            return 200, {'status': 'MAX_ELEMENTS_EXCEEDED', 'rows': []}
+        rows = [{'elements': [dict(status='OK', **element(o, d, params, timezone)) for d in destinations]}
+            for o in origins]
+        return 200, {'status': 'OK', 'origin_addresses': origins,
+            'destination_addresses': destinations, 'rows': rows}
+
+    if path.endswith('/geocode/json'):
+        address = params['address'][0]
+        ## like the real thing, spellings of the same address end up at the 
+        ## same place
+        from geocode import normalize_address
+        lat, lng = synthetic_location(normalize_address(address))
+        return 200, {'status': 'OK', 'results': [{'formatted_address': address,
+            'geometry': {'location': {'lat': lat, 'lng': lng}}}]}
+
+    return 404, {'status': 'NOT_FOUND'}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0
+    timezone = pytz.timezone('America/Los_Angeles')
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, code=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+        parts = urlsplit(self.path)
+        code, data = respond(parts.path, parse_qs(parts.query), self.timezone)
+        self.send_json(data, code)
+
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--port', default=8765, type=int)
+    parser.add_argument('--latency', default=0, type=float, help="Seconds to wait before answering each request")
+    parser.add_argument('--timezone', default='America/Los_Angeles', help="Timezone that rush hour is in")
+
+    args = parser.parse_args()
+
+    StubHandler.latency = args.latency
+    StubHandler.timezone = pytz.timezone(args.timezone)
+    server = ThreadingHTTPServer(('localhost', args.port), StubHandler)
+    print(f"Serving stub maps API at http://localhost:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
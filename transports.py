@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""
+transports are what CommuteTimesClass uses to actually send a request:
+anything with a get(url, timeout) method that returns an object with
+status_code, json() and raise_for_status() (i.e. a requests.Response, or
+a TransportResponse).  besides the real thing (HTTPTransport), there are
+transports to record real responses to disk, replay them later, or make
+them up from the stub traffic model, so we can measure the pipeline
+without spending money.
+"""
+
+import json
+import time
+import threading
+from urllib.parse import urlsplit, parse_qs, parse_qsl, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def normalize_request(url):
+    """
+    normalize a url into a key:  drop the API key and sort the query
+    parameters so equivalent requests map to the same key
+    """
+    parts = urlsplit(url)
+    params = sorted((k, v) for k, v in parse_qsl(parts.query) if k != 'key')
+    return parts.path + '?' + urlencode(params)
+
+
+class TransportResponse:
+    """
+    just enough of a requests.Response for CommuteTimesClass
+    """
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code}: {self.data}")
+
+
+class HTTPTransport:
+    """
+    the real thing:  a pooled keep-alive session with up to pool_size connections
+    """
+    def __init__(self, pool_size=10):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, timeout=None):
+        return self.session.get(url, timeout=timeout)
+
+
+class RecordingTransport:
+    """
+    passes requests through to another transport (HTTPTransport by default)
+    and appends every response to a jsonl file (without the API key), for
+    ReplayTransport to play back later
+    """
+    def __init__(self, filename, transport=None):
+        self.transport = transport if transport is not None else HTTPTransport()
+        self.lock = threading.Lock()
+        self.out = open(filename, 'a')
+
+    def get(self, url, timeout=None):
+        res = self.transport.get(url, timeout=timeout)
+        try:
+            data = res.json()
+        except ValueError:
+            data = None
+        record = {'request': normalize_request(url), 'status_code': res.status_code, 'response': data}
+        with self.lock:
+            self.out.write(json.dumps(record) + '\n')
+            self.out.flush()
+        return res
+
+
+class ReplayTransport:
+    """
+    answers requests from a file written by RecordingTransport, optionally
+    waiting latency seconds per request to mimic the real API.  requests
+    that weren't recorded get a 404.  if a request was recorded more than
+    once, the last response wins
+    """
+    def __init__(self, filename, latency=0):
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.responses = {}
+        with open(filename, 'r') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.responses[record['request']] = (record['status_code'], record['response'])
+
+    def get(self, url, timeout=None):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        request = normalize_request(url)
+        if request not in self.responses:
+            return TransportResponse(404, {'status': 'NOT_FOUND', 'error_message': f'{request} was not recorded'})
+        return TransportResponse(*self.responses[request])
+
+
+class SyntheticTransport:
+    """
+    makes up responses (for both the Directions and Distance Matrix APIs)
+    from the parametric traffic model in stub_server.py, optionally waiting
+    latency seconds per request to mimic the real API
+    """
+    def __init__(self, latency=0, timezone=None):
+        import pytz
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.timezone = timezone if timezone is not None else pytz.timezone('America/Los_Angeles')
+
+    def get(self, url, timeout=None):
+        from stub_server import respond
+
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        parts = urlsplit(url)
+        return TransportResponse(*respond(parts.path, parse_qs(parts.query), self.timezone))
+
+
+def add_transport_arguments(parser):
+    parser.add_argument('--transport', default='http', choices=['http', 'record', 'replay', 'synthetic'],
+        help="How to send requests:  to the API (http), to the API while saving responses to " +
+             "--transport_file (record), from a --transport_file (replay), or made up locally (synthetic)")
+    parser.add_argument('--transport_file', default=None, help="jsonl file of recorded responses for record/replay")
+    parser.add_argument('--latency', default=0, type=float,
+        help="Seconds to wait per request with the replay and synthetic transports")
+
+def transport_from_args(args, pool_size=10):
+    if args.transport in ['record', 'replay'] and args.transport_file is None:
+        raise ValueError(f"Must provide a --transport_file to {args.transport}")
+    if args.transport == 'record':
+        return RecordingTransport(args.transport_file, HTTPTransport(pool_size))
+    if args.transport == 'replay':
+        return ReplayTransport(args.transport_file, latency=args.latency)
+    if args.transport == 'synthetic':
+        return SyntheticTransport(latency=args.latency)
+    return HTTPTransport(pool_size)